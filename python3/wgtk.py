@@ -35,8 +35,27 @@ import re
 import time
 import fcntl
 import errno
+import json
+import copy
+import mmap
+import stat
 import shutil
+import tempfile
+import sqlite3
+import hashlib
+import struct
+import bisect
+import functools
+import threading
+import collections
+import concurrent.futures
 from passlib import hosts
+from passlib import registry
+from passlib.context import CryptContext
+try:
+    import numpy
+except ImportError:
+    numpy = None                # only needed by PasswdGroupShadow.audit()
 
 __author__ = "fpemud@sina.com (Fpemud)"
 __version__ = "0.0.1"
@@ -68,6 +87,249 @@ class PgsAddUserToGroupError(Exception):
     pass
 
 
+class PgsConflictError(Exception):
+    pass
+
+
+class PgsRenumberError(Exception):
+    pass
+
+
+PgsPwdRecord = collections.namedtuple("PgsPwdRecord", ["category", "pw_name", "pw_passwd", "pw_uid", "pw_gid", "pw_gecos", "pw_dir", "pw_shell"])
+PgsGrpRecord = collections.namedtuple("PgsGrpRecord", ["category", "gr_name", "gr_passwd", "gr_gid", "gr_mem"])
+PgsShadowRecord = collections.namedtuple("PgsShadowRecord", ["sh_name", "sh_encpwd"])
+PgsSubUidGidRecord = collections.namedtuple("PgsSubUidGidRecord", ["name", "start", "count"])
+
+
+class _RWLock:
+
+    """Readers-writer lock, writers are preferred so that they won't starve.
+       Write lock is re-entrant, and the writer thread can also take read lock.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readerCount = 0
+        self._writerWaitCount = 0
+        self._writer = None
+        self._writerDepth = 0
+
+    def acquireRead(self):
+        with self._cond:
+            if self._writer == threading.get_ident():
+                self._writerDepth += 1
+                return
+            while self._writer is not None or self._writerWaitCount > 0:
+                self._cond.wait()
+            self._readerCount += 1
+
+    def releaseRead(self):
+        with self._cond:
+            if self._writer == threading.get_ident():
+                self._writerDepth -= 1
+                return
+            assert self._readerCount > 0
+            self._readerCount -= 1
+            if self._readerCount == 0:
+                self._cond.notify_all()
+
+    def acquireWrite(self):
+        with self._cond:
+            if self._writer == threading.get_ident():
+                self._writerDepth += 1
+                return
+            self._writerWaitCount += 1
+            try:
+                while self._writer is not None or self._readerCount > 0:
+                    self._cond.wait()
+            finally:
+                self._writerWaitCount -= 1
+            self._writer = threading.get_ident()
+            self._writerDepth = 1
+
+    def releaseWrite(self):
+        with self._cond:
+            assert self._writer == threading.get_ident()
+            self._writerDepth -= 1
+            if self._writerDepth == 0:
+                self._writer = None
+                self._cond.notify_all()
+
+
+class _DummyRWLock:
+
+    def acquireRead(self):
+        pass
+
+    def releaseRead(self):
+        pass
+
+    def acquireWrite(self):
+        pass
+
+    def releaseWrite(self):
+        pass
+
+
+class _SubIdIndex:
+
+    """Sorted interval index over subordinate ID ranges."""
+
+    def __init__(self, entryDict):
+        entryList = sorted(entryDict.values(), key=lambda x: (x.start, x.start + x.count))
+        self._startList = [x.start for x in entryList]
+        self._entryList = entryList
+
+        # the entry with the largest range end among entryList[0..i]
+        self._prefixMaxEntryList = []
+        m = None
+        for e in entryList:
+            if m is None or e.start + e.count > m.start + m.count:
+                m = e
+            self._prefixMaxEntryList.append(m)
+
+    def findOwner(self, theId):
+        """returns the name of the owner, None if not found, O(log n)"""
+        i = bisect.bisect_right(self._startList, theId) - 1
+        if i < 0:
+            return None
+        if theId < self._entryList[i].start + self._entryList[i].count:
+            return self._entryList[i].name
+        m = self._prefixMaxEntryList[i]
+        if theId < m.start + m.count:
+            return m.name
+        return None
+
+    def findOverlaps(self):
+        """returns [(name1, name2)] in which range of name2 overlaps with or duplicates range of name1, O(n)"""
+        ret = []
+        m = None
+        for e in self._entryList:
+            if m is not None and e.start < m.start + m.count:
+                ret.append((m.name, e.name))
+            if m is None or e.start + e.count > m.start + m.count:
+                m = e
+        return ret
+
+
+class _Tracer:
+
+    """Records API calls of PasswdGroupShadow into a trace file, one JSON object per line.
+       Fields: i: instance key, op: function name, a: arguments, k: keyword arguments, t: start time, d: duration, e: exception name,
+               h: resulting [scheme, rounds] of the hashing policy, only for the calls that change it
+       Passwords are redacted."""
+
+    redactedPassword = "<redacted>"
+    hashPolicyOpList = ["setHashPolicy", "calibrateHashPolicy"]
+
+    def __init__(self, traceFile):
+        self._f = open(traceFile, "a", buffering=1)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._key = "%d-%x" % (os.getpid(), id(self))
+
+    def enter(self):
+        """returns True if it is the outermost traced call of current thread"""
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        return depth == 0
+
+    def leave(self):
+        self._local.depth -= 1
+
+    def record(self, funcName, kargs, kwargs, startTime, duration, error, hashPolicy=None):
+        kargs, kwargs = self._redact(funcName, list(kargs), dict(kwargs))
+        obj = {
+            "i": self._key,
+            "op": funcName,
+            "a": kargs,
+            "t": startTime,
+            "d": duration,
+        }
+        if len(kwargs) > 0:
+            obj["k"] = kwargs
+        if error is not None:
+            obj["e"] = error.__class__.__name__
+        if hashPolicy is not None:
+            obj["h"] = hashPolicy
+        with self._lock:
+            if self._f is not None:
+                self._f.write(json.dumps(obj, separators=(",", ":")) + "\n")
+
+    def close(self):
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+
+    def _redact(self, funcName, kargs, kwargs):
+        if funcName in ["addNormalUser", "verifyPassword"]:
+            if len(kargs) >= 2:
+                kargs[1] = self.redactedPassword
+            if "password" in kwargs:
+                kwargs["password"] = self.redactedPassword
+        elif funcName == "modifyNormalUser" and len(kargs) >= 3 and kargs[1] == MUSER_SET_PASSWORD:
+            kargs[2] = self.redactedPassword
+        elif funcName == "renumber":
+            # JSON object can't have integer keys
+            kargs = [sorted(x.items()) if x is not None else None for x in kargs]
+            kwargs = {k: sorted(v.items()) if v is not None else None for k, v in kwargs.items()}
+        return (kargs, kwargs)
+
+
+def _traced(func):
+    @functools.wraps(func)
+    def wrapper(self, *kargs, **kwargs):
+        tracer = self._tracer
+        if tracer is None:
+            return func(self, *kargs, **kwargs)
+        if not tracer.enter():
+            try:
+                return func(self, *kargs, **kwargs)
+            finally:
+                tracer.leave()
+
+        startTime = time.time()
+        t = time.perf_counter()
+        error = None
+        try:
+            return func(self, *kargs, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            tracer.leave()
+            hashPolicy = None
+            if func.__name__ in tracer.hashPolicyOpList and error is None:
+                hashPolicy = [self.hashScheme, self.hashRounds]
+            tracer.record(func.__name__, kargs, kwargs, startTime, time.perf_counter() - t, error, hashPolicy)
+            if not self.valid:
+                tracer.close()
+    return wrapper
+
+
+def _readLocked(func):
+    @functools.wraps(func)
+    def wrapper(self, *kargs, **kwargs):
+        self._rwLock.acquireRead()
+        try:
+            return func(self, *kargs, **kwargs)
+        finally:
+            self._rwLock.releaseRead()
+    return wrapper
+
+
+def _writeLocked(func):
+    @functools.wraps(func)
+    def wrapper(self, *kargs, **kwargs):
+        self._rwLock.acquireWrite()
+        try:
+            return func(self, *kargs, **kwargs)
+        finally:
+            self._rwLock.releaseWrite()
+    return wrapper
+
+
 class PasswdGroupShadow:
 
     """Unix account files with special format and rules.
@@ -78,6 +340,16 @@ class PasswdGroupShadow:
            /etc/gshadow
            /etc/subuid
            /etc/subgid
+
+       The account data is loaded from and stored into a backend, which is PgsFlatFileBackend by default.
+       Classification, verification and fixation rules are the same for all the backends.
+
+       In optimistic mode, the account files are not locked until commit. Mutations are recorded,
+       and if the files are changed by others in the meantime, they are replayed on the fresh content
+       in close(). PgsConflictError is raised if the replay fails.
+
+       In thread-safe mode, one instance can be shared by many threads:
+       getters run concurrently, mutations and close() are serialized.
     """
 
     class _PwdEntry:
@@ -158,11 +430,46 @@ class PasswdGroupShadow:
     _stdDeviceGroupList = ["tty", "disk", "lp", "mem", "kmem", "floppy", "console", "audio", "cdrom", "tape", "video", "cdrw", "usb", "plugdev", "input", "kvm"]
     _stdDeprecatedGroupList = ["bin", "daemon", "sys", "adm"]
 
-    def __init__(self, dirPrefix="/", readOnly=True, msrc="strict_pgs"):
+    _encryptMethodDict = {
+        "DES": "des_crypt",
+        "MD5": "md5_crypt",
+        "SHA256": "sha256_crypt",
+        "SHA512": "sha512_crypt",
+    }
+
+    _modelListAttrList = [
+        "systemUserList", "normalUserList", "softwareUserList", "deprecatedUserList",
+        "systemGroupList", "deviceGroupList", "perUserGroupList", "standAloneGroupList", "softwareGroupList", "deprecatedGroupList",
+        "shadowEntryList", "subUidEntryList", "subGidEntryList",
+    ]
+    _modelDictAttrList = [
+        "pwdDict", "grpDict", "shDict", "subUidDict", "subGidDict", "secondaryGroupsDict",
+    ]
+
+    def __init__(self, dirPrefix="/", readOnly=True, msrc="strict_pgs", threadSafe=False, homeProvisioner=None, sharedModelFile=None, optimistic=False,
+                 traceFile=None, backend=None, auditOnly=False):
+        """if auditOnly is True, the account files are loaded without verification, so that audit() can report all the violations,
+           readOnly must be True in this case"""
+        self._tracer = None
+        traceStartTime = time.time()
+        traceT = time.perf_counter()
+
         self.valid = True
         self.dirPrefix = dirPrefix
         self.readOnly = readOnly
+        self.optimistic = optimistic
+        self.auditOnly = auditOnly
+        assert not self.auditOnly or self.readOnly
+        self.backend = backend if backend is not None else PgsFlatFileBackend()
         self.manageFlag = "# manged by %s" % (msrc)
+        self.homeProvisioner = homeProvisioner
+        self.sharedModelFile = sharedModelFile
+
+        self.threadSafe = threadSafe
+        if self.threadSafe:
+            self._rwLock = _RWLock()
+        else:
+            self._rwLock = _DummyRWLock()
 
         self.loginDefFile = os.path.join(dirPrefix, "etc", "login.defs")
         self.passwdFile = os.path.join(dirPrefix, "etc", "passwd")
@@ -186,6 +493,9 @@ class PasswdGroupShadow:
         self.subGidMin = -1
         self.subGidMax = -1
         self.subGidCount = -1
+        self.encryptMethod = None               # optional
+        self.shaCryptMinRounds = None           # optional
+        self.shaCryptMaxRounds = None           # optional
 
         # filled by _parsePasswd
         self.systemUserList = []
@@ -216,23 +526,77 @@ class PasswdGroupShadow:
         self.subGidEntryList = []
         self.subGidDict = dict()                # key: username; value: _SubUidGidEntry
 
+        # password hashing policy, filled by setHashPolicy
+        self.hashScheme = None
+        self.hashRounds = None
+        self._hashContext = None
+
+        # statistics
+        self._stats = {
+            "hashCount": 0,
+            "hashTime": 0.0,
+            "verifyCount": 0,
+            "verifyTime": 0.0,
+        }
+        self._statsLock = threading.Lock()
+
+        # filled on demand, cleared when subUidDict or subGidDict is changed
+        self._subUidIndex = None
+        self._subGidIndex = None
+
+        # optimistic mode, key: filename; value: digest of the content read
+        self._fileDigestDict = None
+        self._mutationLog = None
+        if self.optimistic:
+            assert not self.readOnly
+            self._fileDigestDict = dict()
+            self._mutationLog = []
+
+        # number of successful commits
+        self._commitCount = 0
+
+        # group commit state
+        self._groupCommitCond = threading.Condition(threading.Lock())
+        self._groupCommitCollecting = False
+        self._groupCommitBatch = 1              # the batch collecting commit() calls
+        self._groupCommitDone = 0               # the last batch written
+        self._groupCommitKeepLock = None        # keepLock of the batch collecting commit() calls
+        self._groupCommitFollowerDict = dict()  # key: batch; value: number of commit() calls waiting for the batch
+        self._groupCommitErrorDict = dict()     # key: batch; value: exception
+
+        # copy-on-write state, None means all the entries are owned by this object
+        self._cowOwnedIdSet = None
+        self._cowParent = None
+
         # do parsing
         self._parseLoginDef()
-        if not self.readOnly:
+
+        # hashing policy is taken from login.defs by default
+        self.setHashPolicy()
+
+        if not self.readOnly and not self.optimistic:
             self._lockPwd()
         try:
-            self._parsePasswd()
-            self._parseGroup(self.normalUserList)
-            self._parseShadow()
-            self._parseSubUid()
-            self._parseSubGid()
+            self._parseAll()
+
+            # do verify
+            if not self.auditOnly:
+                self._verifyStage1()
         except:
-            if not self.readOnly:
+            if not self.readOnly and not self.optimistic:
                 self._unlockPwd()
             raise
 
-        # do verify
-        self._verifyStage1()
+        # home directories of normal users at last commit, key: username; value: pw_dir
+        self._homeBaseDict = None
+        if self.homeProvisioner is not None:
+            self._homeBaseDict = self._getHomeDict()
+
+        # record API calls, see replayTrace()
+        if traceFile is not None:
+            self._tracer = _Tracer(traceFile)
+            self._tracer.record("open", [dirPrefix, readOnly, optimistic, threadSafe], {"backend": self.backend.__class__.__name__, "auditOnly": auditOnly},
+                                traceStartTime, time.perf_counter() - traceT, None)
 
     def __enter__(self):
         return self
@@ -240,45 +604,261 @@ class PasswdGroupShadow:
     def __exit__(self, type, value, traceback):
         self.close()
 
+    @_readLocked
     def getSystemUserList(self):
         """returns system user name list"""
         assert self.valid
-        return self.systemUserList
+        return self._retList(self.systemUserList)
 
+    @_readLocked
     def getNormalUserList(self):
         """returns normal user name list"""
         assert self.valid
-        return self.normalUserList
+        return self._retList(self.normalUserList)
 
+    @_readLocked
     def getSystemGroupList(self):
         """returns system group name list"""
         assert self.valid
-        return self.systemGroupList
+        return self._retList(self.systemGroupList)
 
+    @_readLocked
     def getStandAloneGroupList(self):
         """returns stand-alone group name list"""
         assert self.valid
-        return self.standAloneGroupList
+        return self._retList(self.standAloneGroupList)
 
+    @_readLocked
     def getSoftwareGroupList(self):
         """returns software group name list"""
         assert self.valid
-        return self.softwareGroupList
+        return self._retList(self.softwareGroupList)
 
+    @_readLocked
     def getSecondaryGroupsOfUser(self, username):
         """returns group name list"""
         assert self.valid
         assert username in self.normalUserList
         return sorted(self.secondaryGroupsDict.get(username, []))
 
+    @_readLocked
+    def getStats(self):
+        """returns statistics dict
+           hashCount: number of password hashed
+           hashTime:  total time (in seconds) spent on hashing password
+           verifyCount: number of verifyPassword() calls
+           verifyTime:  total time (in seconds) spent in verifyPassword()"""
+        assert self.valid
+        with self._statsLock:
+            return dict(self._stats)
+
+    @_traced
+    @_readLocked
+    def verifyPassword(self, username, password):
+        """check password against the shadow entry of the user in the in-memory model
+           returns (match, needsUpdate), needsUpdate is True if the hash doesn't comply with the current hashing policy,
+           caller should then re-hash the password by modifyNormalUser(MUSER_SET_PASSWORD)
+           hash comparision is done in constant time by passlib"""
+        assert self.valid
+
+        t = time.perf_counter()
+        try:
+            entry = self.shDict.get(username)
+            if entry is None:
+                return (False, False)
+            try:
+                if not self._hashContext.verify(password, entry.sh_encpwd):
+                    return (False, False)
+            except ValueError:
+                # no password, locked account, or unknown hash format
+                return (False, False)
+            return (True, self._hashContext.needs_update(entry.sh_encpwd))
+        finally:
+            self._addStats("verifyCount", "verifyTime", time.perf_counter() - t)
+
+    @_traced
+    @_writeLocked
+    def setHashPolicy(self, scheme=None, rounds=None):
+        """set the scheme and rounds used for hashing password
+           scheme is a passlib scheme name (sha512_crypt, sha256_crypt, md5_crypt, des_crypt), rounds is only valid for sha*_crypt
+           ENCRYPT_METHOD, SHA_CRYPT_MIN_ROUNDS and SHA_CRYPT_MAX_ROUNDS in login.defs are used if they are not specified"""
+        assert self.valid
+
+        minRounds = None
+        maxRounds = None
+        if scheme is None:
+            scheme = self._encryptMethodDict.get(self.encryptMethod, hosts.linux_context.default_scheme())
+            if scheme in ["sha256_crypt", "sha512_crypt"]:
+                minRounds = self.shaCryptMinRounds
+                maxRounds = self.shaCryptMaxRounds
+                if rounds is None:
+                    rounds = minRounds if minRounds is not None else maxRounds
+        if scheme not in hosts.linux_context.schemes():
+            raise ValueError("Invalid password hashing scheme %s" % (scheme))
+        if rounds is not None and "rounds" not in registry.get_crypt_handler(scheme).setting_kwds:
+            raise ValueError("Password hashing scheme %s has no rounds" % (scheme))
+
+        kwargs = dict()
+        if rounds is not None:
+            kwargs["%s__default_rounds" % (scheme)] = rounds
+        if minRounds is not None:
+            kwargs["%s__min_rounds" % (scheme)] = minRounds
+        if maxRounds is not None:
+            kwargs["%s__max_rounds" % (scheme)] = maxRounds
+
+        schemeList = [scheme] + [x for x in hosts.linux_context.schemes() if x != scheme]
+        self._hashContext = CryptContext(schemes=schemeList, default=scheme, deprecated=["auto"], **kwargs)
+        self.hashScheme = scheme
+        self.hashRounds = rounds
+
+    @_traced
+    def calibrateHashPolicy(self, targetTime, scheme=None):
+        """measure hashing speed on current machine, and set hashing policy so that hashing one password costs about targetTime seconds
+           for sha*_crypt, rounds is kept in the range of SHA_CRYPT_MIN_ROUNDS and SHA_CRYPT_MAX_ROUNDS in login.defs
+           returns the rounds selected"""
+        assert self.valid
+
+        if scheme is None:
+            scheme = self._encryptMethodDict.get(self.encryptMethod, hosts.linux_context.default_scheme())
+        handler = registry.get_crypt_handler(scheme)
+        if "rounds" not in handler.setting_kwds:
+            raise ValueError("Password hashing scheme %s has no rounds" % (scheme))
+
+        probeRounds = max(handler.min_rounds, 10000)
+        ctx = CryptContext(schemes=[scheme], **{"%s__default_rounds" % (scheme): probeRounds})
+        elapsed = None
+        for i in range(3):
+            t = time.perf_counter()
+            ctx.encrypt("calibrate")
+            t = time.perf_counter() - t
+            if elapsed is None or t < elapsed:
+                elapsed = t
+
+        rounds = int(probeRounds * targetTime / max(elapsed, 1e-6))
+        rounds = max(handler.min_rounds, min(rounds, handler.max_rounds))
+        if scheme in ["sha256_crypt", "sha512_crypt"]:
+            if self.shaCryptMaxRounds is not None:
+                rounds = min(rounds, self.shaCryptMaxRounds)
+            if self.shaCryptMinRounds is not None:
+                rounds = max(rounds, self.shaCryptMinRounds)
+        self.setHashPolicy(scheme, rounds)
+        return rounds
+
+    @_readLocked
+    def ownerOfSubUid(self, subUid):
+        """returns the name of the user whose subordinate user ID range contains subUid, None if not found"""
+        assert self.valid
+        return self._getSubUidIndex().findOwner(subUid)
+
+    @_readLocked
+    def ownerOfSubGid(self, subGid):
+        """returns the name of the user whose subordinate group ID range contains subGid, None if not found"""
+        assert self.valid
+        return self._getSubGidIndex().findOwner(subGid)
+
+    @_readLocked
+    def audit(self):
+        """check the criteria verified on opening, ID related ones are checked by array operations, numpy is needed
+           unlike verify(), all the violations are collected instead of raising on the first one,
+           open with auditOnly=True so that the account files with such violations can be loaded
+           returns list of violation messages, empty if all is well"""
+        assert self.valid
+        if numpy is None:
+            raise RuntimeError("audit() needs numpy")
+
+        ret = []
+
+        # user and group lists
+        if set(self.systemUserList) != set(self._stdSystemUserList):
+            ret.append("Invalid system user list")
+        for uname in self.systemUserList:
+            if uname not in self.shDict:
+                ret.append("No shadow entry for system user %s" % (uname))
+        for uname in self.normalUserList:
+            if uname not in self.shDict:
+                ret.append("No shadow entry for normal user %s" % (uname))
+            elif len(self.shDict[uname].sh_encpwd) <= 4:
+                ret.append("No password for normal user %s" % (uname))
+        if set(self.systemGroupList) != set(self._stdSystemGroupList):
+            ret.append("Invalid system group list")
+        if set(self.perUserGroupList) != set(self.normalUserList):
+            ret.append("Invalid per-user group list")
+
+        def _ids(nameList, entryDict, attr):
+            return numpy.fromiter((getattr(entryDict[x], attr) for x in nameList), dtype=numpy.int64, count=len(nameList))
+
+        def _report(mask, nameList, fmt):
+            for i in numpy.nonzero(mask)[0]:
+                ret.append(fmt % (nameList[i]))
+
+        def _reportDuplicate(ids, nameList, fmt):
+            values, counts = numpy.unique(ids, return_counts=True)
+            for v in values[counts > 1]:
+                ret.append(fmt % (v, ", ".join([nameList[i] for i in numpy.nonzero(ids == v)[0]])))
+
+        # normal users
+        uids = _ids(self.normalUserList, self.pwdDict, "pw_uid")
+        _report((uids < self.uidMin) | (uids >= self.uidMax), self.normalUserList, "User ID out of range for normal user %s")
+        _report(numpy.diff(uids) < 0, self.normalUserList[1:], "Invalid normal user order at user %s")
+        hasGroup = numpy.fromiter((x in self.grpDict for x in self.normalUserList), dtype=bool, count=len(self.normalUserList))
+        gids = numpy.fromiter((self.grpDict[x].gr_gid if x in self.grpDict else -1 for x in self.normalUserList), dtype=numpy.int64, count=len(self.normalUserList))
+        _report(~hasGroup, self.normalUserList, "No per-user group for normal user %s")
+        _report(hasGroup & (uids != gids), self.normalUserList, "User ID and group ID not equal for normal user %s")
+
+        # software users
+        uids = _ids(self.softwareUserList, self.pwdDict, "pw_uid")
+        _report(uids >= self.uidMin, self.softwareUserList, "User ID out of range for software user %s")
+
+        # stand-alone groups
+        gids = _ids(self.standAloneGroupList, self.grpDict, "gr_gid")
+        _report((gids < self.gidMin) | (gids >= self.gidMax), self.standAloneGroupList, "Group ID out of range for stand-alone group %s")
+        _report(numpy.diff(gids) < 0, self.standAloneGroupList[1:], "Invalid stand-alone group order at group %s")
+
+        # software groups
+        gids = _ids(self.softwareGroupList, self.grpDict, "gr_gid")
+        _report(gids >= self.gidMin, self.softwareGroupList, "Group ID out of range for software group %s")
+
+        # uniqueness
+        nameList = list(self.pwdDict.keys())
+        _reportDuplicate(_ids(nameList, self.pwdDict, "pw_uid"), nameList, "User ID %d is used by multiple users: %s")
+        nameList = list(self.grpDict.keys())
+        _reportDuplicate(_ids(nameList, self.grpDict, "gr_gid"), nameList, "Group ID %d is used by multiple groups: %s")
+
+        # subordinate IDs
+        for desc, entryDict, idMin, idMax, idCount in [("User", self.subUidDict, self.subUidMin, self.subUidMax, self.subUidCount),
+                                                       ("Group", self.subGidDict, self.subGidMin, self.subGidMax, self.subGidCount)]:
+            nameList = list(entryDict.keys())
+            starts = _ids(nameList, entryDict, "start")
+            counts = _ids(nameList, entryDict, "count")
+            _report((starts < idMin) | (starts >= idMax), nameList, "Subordinate " + desc + " ID out of range for user %s")
+            _report((starts - idMin) % idCount != 0, nameList, "Subordinate " + desc + " ID is not aligned for user %s")
+            _report(counts != idCount, nameList, "Subordinate " + desc + " ID count is different from " + self.loginDefFile.replace("%", "%%") + " for user %s")
+
+            # overlap: sort by start, a range overlaps if it starts before the maximum end of all the previous ranges
+            order = numpy.argsort(starts, kind="stable")
+            sortedNameList = [nameList[i] for i in order]
+            ends = numpy.maximum.accumulate(starts[order] + counts[order])
+            _report(starts[order][1:] < ends[:-1], sortedNameList[1:], "Subordinate " + desc + " ID range overlaps for user %s")
+
+        return ret
+
+    @_traced
+    @_readLocked
     def verify(self):
         """check account files according to the critiera"""
         assert self.valid
         self._verifyStage1()
         self._verifyStage2()
 
+    @_traced
+    @_writeLocked
     def addNormalUser(self, username, password):
         assert self.valid
+        encPassword = self._hashPassword(password)
+        self._addNormalUser(username, encPassword)
+        self._journal("_addNormalUser", username, encPassword)
+
+    def _addNormalUser(self, username, encPassword):
         assert username not in self.pwdDict
         assert username not in self.grpDict
 
@@ -304,7 +884,7 @@ class PasswdGroupShadow:
         self.perUserGroupList.append(username)
 
         # add shadow
-        self.shDict[username] = self._ShadowEntry(username, hosts.linux_context.encrypt(password), "", "", "", "", "", "", "")
+        self.shDict[username] = self._ShadowEntry(username, encPassword, "", "", "", "", "", "", "")
         self.shadowEntryList.append(username)
 
         # add subuid
@@ -313,6 +893,7 @@ class PasswdGroupShadow:
             m = max(obj.start + obj.count, m)
         self.subUidDict[username] = self._SubUidGidEntry(username, m, self.subUidCount)
         self.subUidEntryList.append(username)
+        self._subUidIndex = None
 
         # add subgid
         m = self.subGidMin
@@ -320,7 +901,10 @@ class PasswdGroupShadow:
             m = max(obj.start + obj.count, m)
         self.subGidDict[username] = self._SubUidGidEntry(username, m, self.subGidCount)
         self.subGidEntryList.append(username)
+        self._subGidIndex = None
 
+    @_traced
+    @_writeLocked
     def removeNormalUser(self, username):
         """do nothing if the user doesn't exists"""
         assert self.valid
@@ -328,10 +912,12 @@ class PasswdGroupShadow:
         if username in self.subGidEntryList:
             self.subGidEntryList.remove(username)
             del self.subGidDict[username]
+            self._subGidIndex = None
 
         if username in self.subUidEntryList:
             self.subUidEntryList.remove(username)
             del self.subUidDict[username]
+            self._subUidIndex = None
 
         if username in self.shadowEntryList:
             self.shadowEntryList.remove(username)
@@ -343,7 +929,7 @@ class PasswdGroupShadow:
             ulist = [x for x in entry.gr_mem.split(",") if x != ""]
             if username in ulist:
                 ulist.remove(username)
-                self.grpDict[gname].gr_mem = ",".join(ulist)
+                self._cowEntry(self.grpDict, gname).gr_mem = ",".join(ulist)
 
         if username in self.perUserGroupList:
             self.perUserGroupList.remove(username)
@@ -353,6 +939,10 @@ class PasswdGroupShadow:
             self.normalUserList.remove(username)
             del self.pwdDict[username]
 
+        self._journal("removeNormalUser", username)
+
+    @_traced
+    @_writeLocked
     def modifyNormalUser(self, username, op, *kargs):
         assert self.valid
         assert username in self.normalUserList
@@ -360,7 +950,9 @@ class PasswdGroupShadow:
         if op == MUSER_SET_PASSWORD:
             assert len(kargs) == 1
             password = kargs[0]
-            self.shDict[username].sh_encpwd = hosts.linux_context.encrypt(password)
+            encPassword = self._hashPassword(password)
+            self._setEncryptedPassword(username, encPassword)
+            self._journal("_setEncryptedPassword", username, encPassword)
         elif op == MUSER_SET_SHELL:
             assert False
         elif op == MUSER_JOIN_GROUP:
@@ -370,24 +962,32 @@ class PasswdGroupShadow:
             if username not in self.secondaryGroupsDict:
                 self.secondaryGroupsDict[username] = []
             if groupname not in self.secondaryGroupsDict[username]:
-                self.secondaryGroupsDict[username].append(groupname)
+                self._cowEntry(self.secondaryGroupsDict, username).append(groupname)
             ulist = [x for x in self.grpDict[groupname].gr_mem.split(",") if x != ""]
             if username not in ulist:
                 ulist.append(username)
-                self.grpDict[groupname].gr_mem = ",".join(ulist)
+                self._cowEntry(self.grpDict, groupname).gr_mem = ",".join(ulist)
+            self._journal("modifyNormalUser", username, op, groupname)
         elif op == MUSER_LEAVE_GROUP:
             assert len(kargs) == 1
             groupname = kargs[0]
             if username in self.secondaryGroupsDict:
                 if groupname in self.secondaryGroupsDict[username]:
-                    self.secondaryGroupsDict[username].remove(groupname)
+                    self._cowEntry(self.secondaryGroupsDict, username).remove(groupname)
             ulist = [x for x in self.grpDict[groupname].gr_mem.split(",") if x != ""]
             if username in ulist:
                 ulist.remove(username)
-                self.grpDict[groupname].gr_mem = ",".join(ulist)
+                self._cowEntry(self.grpDict, groupname).gr_mem = ",".join(ulist)
+            self._journal("modifyNormalUser", username, op, groupname)
         else:
             assert False
 
+    def _setEncryptedPassword(self, username, encPassword):
+        assert username in self.normalUserList
+        self._cowEntry(self.shDict, username).sh_encpwd = encPassword
+
+    @_traced
+    @_writeLocked
     def addStandAloneGroup(self, groupname):
         assert self.valid
         assert groupname not in self.grpDict
@@ -397,7 +997,7 @@ class PasswdGroupShadow:
         while True:
             if newGid >= 10000:
                 raise PgsAddGroupError("Can not find a valid group id")
-            if newGid in [v.grp_gid for v in self.grpDict.values()]:
+            if newGid in [v.gr_gid for v in self.grpDict.values()]:
                 newGid += 1
                 continue
             break
@@ -406,154 +1006,527 @@ class PasswdGroupShadow:
         self.grpDict[groupname] = self._GrpEntry(groupname, "x", newGid, "")
         self.standAloneGroupList.append(groupname)
 
+        self._journal("addStandAloneGroup", groupname)
+
+    @_traced
+    @_writeLocked
     def removeStandAloneGroup(self, groupname):
         assert self.valid
 
-        for glist in self.secondaryGroupsDict.values():
+        for uname, glist in self.secondaryGroupsDict.items():
             if groupname in glist:
-                glist.remove(groupname)
+                self._cowEntry(self.secondaryGroupsDict, uname).remove(groupname)
 
         if groupname in self.standAloneGroupList:
             self.standAloneGroupList.remove(groupname)
             del self.grpDict[groupname]
 
+        self._journal("removeStandAloneGroup", groupname)
+
+    @_traced
+    @_writeLocked
+    def renumber(self, uidMap=None, gidMap=None):
+        """change ID of normal users and stand-alone groups, uidMap and gidMap are dicts, key: old ID; value: new ID
+           per-user group is renumbered together with its user
+           new IDs must not be in use, so that the ownership rewrite is idempotent
+           returns a PgsChownWalker which rewrites file ownership accordingly"""
+        assert self.valid
+
+        uidMap = dict(uidMap) if uidMap is not None else dict()
+        gidMap = dict(gidMap) if gidMap is not None else dict()
+        uid2user = {self.pwdDict[x].pw_uid: x for x in self.normalUserList}
+        gid2group = {self.grpDict[x].gr_gid: x for x in self.standAloneGroupList}
+
+        # check
+        for oldUid, newUid in uidMap.items():
+            if oldUid not in uid2user:
+                raise PgsRenumberError("User ID %d does not belong to a normal user" % (oldUid))
+            if not (self.uidMin <= newUid < self.uidMax):
+                raise PgsRenumberError("User ID %d out of range" % (newUid))
+        for oldGid, newGid in gidMap.items():
+            if oldGid not in gid2group:
+                raise PgsRenumberError("Group ID %d does not belong to a stand-alone group" % (oldGid))
+            if not (self.gidMin <= newGid < self.gidMax):
+                raise PgsRenumberError("Group ID %d out of range" % (newGid))
+        fullGidMap = dict(gidMap)
+        fullGidMap.update(uidMap)
+        if len(fullGidMap) != len(uidMap) + len(gidMap):
+            raise PgsRenumberError("Group ID is renumbered twice")
+        if len(set(fullGidMap.values())) != len(fullGidMap):
+            raise PgsRenumberError("Duplicate new ID")
+        usedUidSet = set([x.pw_uid for x in self.pwdDict.values()])
+        usedGidSet = set([x.gr_gid for x in self.grpDict.values()])
+        for newUid in uidMap.values():
+            if newUid in usedUidSet:
+                raise PgsRenumberError("User ID %d is already in use" % (newUid))
+        for newGid in fullGidMap.values():
+            if newGid in usedGidSet:
+                raise PgsRenumberError("Group ID %d is already in use" % (newGid))
+
+        # renumber users
+        for oldUid, newUid in uidMap.items():
+            self._cowEntry(self.pwdDict, uid2user[oldUid]).pw_uid = newUid
+        for uname, e in self.pwdDict.items():
+            if e.pw_gid in fullGidMap:
+                self._cowEntry(self.pwdDict, uname).pw_gid = fullGidMap[e.pw_gid]
+
+        # renumber groups
+        for oldUid, newUid in uidMap.items():
+            self._cowEntry(self.grpDict, uid2user[oldUid]).gr_gid = newUid
+        for oldGid, newGid in gidMap.items():
+            self._cowEntry(self.grpDict, gid2group[oldGid]).gr_gid = newGid
+
+        self._journal("renumber", uidMap, gidMap)
+        return PgsChownWalker(uidMap, fullGidMap)
+
+    @_readLocked
+    def publishSharedModel(self, filename):
+        """write names, IDs and memberships of the in-memory model into filename, as a new generation,
+           worker processes can read it by PgsSharedModel without parsing the account files
+           it is also done by close() if sharedModelFile is specified"""
+        assert self.valid
+        self._publishSharedModel(filename)
+
+    @_writeLocked
+    def snapshot(self):
+        """returns a read-only copy-on-write fork of the in-memory model
+           the fork can be modified freely without affecting this object, it can be discarded by close() or be promoted by promote()
+           name lists and lookup dicts are shallow-copied, which is O(n) but doesn't copy any entry,
+           entries are shared until either side modifies them"""
+        assert self.valid
+
+        ret = self.__class__.__new__(self.__class__)
+        ret.__dict__.update(self.__dict__)
+        ret.readOnly = True
+        ret.lockFd = None
+        ret.threadSafe = False
+        ret._rwLock = _DummyRWLock()
+        ret._tracer = None
+        ret._stats = dict(self._stats)
+        ret._statsLock = threading.Lock()
+        if self._mutationLog is not None:
+            ret._mutationLog = list(self._mutationLog)
+            ret._fileDigestDict = dict(self._fileDigestDict)
+        for attr in self._modelListAttrList + self._modelDictAttrList:
+            setattr(ret, attr, copy.copy(getattr(self, attr)))
+
+        # all the existing entries are shared from now on
+        self._cowOwnedIdSet = set()
+        ret._cowOwnedIdSet = set()
+        ret._cowParent = self
+        return ret
+
+    @_writeLocked
+    def promote(self, snapshot):
+        """replaces the in-memory model with the one of a snapshot taken from this object, the snapshot becomes invalid
+           changes made to this object after the snapshot was taken are discarded
+           in optimistic mode, this object must not be committed between snapshot() and promote()"""
+        assert self.valid
+        assert snapshot.valid and snapshot._cowParent is self
+        assert not self.optimistic or snapshot._commitCount == self._commitCount
+
+        for attr in self._modelListAttrList + self._modelDictAttrList:
+            setattr(self, attr, getattr(snapshot, attr))
+        self._mutationLog = snapshot._mutationLog
+        self._cowOwnedIdSet = set()
+        self._subUidIndex = None
+        self._subGidIndex = None
+        snapshot.valid = False
+
+    @_traced
+    def commit(self, keepLock=None, groupCommitWindow=0):
+        """write the in-memory model into the account files, the object remains valid after commit
+           if keepLock is True, the lock is held after commit, an object in optimistic mode leaves optimistic mode
+           if keepLock is False, the lock is released and later changes are committed in optimistic mode
+           if keepLock is None, the object stays in its current mode
+           if groupCommitWindow (in seconds) is not 0, commit() calls from other threads in the window are merged into one write,
+           which is only useful in thread-safe mode, keepLock must be the same for all the merged calls"""
+        assert self.valid
+        assert not self.readOnly
+
+        if groupCommitWindow <= 0:
+            self._commitAndKeepLock(keepLock)
+            return
+
+        with self._groupCommitCond:
+            batch = self._groupCommitBatch
+            leader = not self._groupCommitCollecting
+            if leader:
+                self._groupCommitCollecting = True
+                self._groupCommitKeepLock = keepLock
+            else:
+                assert keepLock == self._groupCommitKeepLock
+                self._groupCommitFollowerDict[batch] = self._groupCommitFollowerDict.get(batch, 0) + 1
+
+        if leader:
+            time.sleep(groupCommitWindow)
+            with self._groupCommitCond:
+                self._groupCommitCollecting = False
+                self._groupCommitBatch += 1
+            try:
+                self._commitAndKeepLock(keepLock)
+            except Exception as e:
+                with self._groupCommitCond:
+                    if batch in self._groupCommitFollowerDict:
+                        self._groupCommitErrorDict[batch] = e
+                raise
+            finally:
+                with self._groupCommitCond:
+                    self._groupCommitDone = batch
+                    self._groupCommitCond.notify_all()
+        else:
+            with self._groupCommitCond:
+                while self._groupCommitDone < batch:
+                    self._groupCommitCond.wait()
+                error = self._groupCommitErrorDict.get(batch)
+
+                # the last follower cleans up
+                self._groupCommitFollowerDict[batch] -= 1
+                if self._groupCommitFollowerDict[batch] == 0:
+                    del self._groupCommitFollowerDict[batch]
+                    self._groupCommitErrorDict.pop(batch, None)
+            if error is not None:
+                raise error
+
+    @_traced
+    @_writeLocked
     def close(self):
         assert self.valid
 
         if not self.readOnly:
-            self._fixate()
-            self._writePasswd()
-            self._writeGroup()
-            self._writeShadow()
-            self._writeGroupShadow()
-            self._writeSubUid()
-            self._writeSubGid()
-            self._unlockPwd()
+            self._commit()
+            if self.lockFd is not None:
+                self._unlockPwd()
         self.valid = False
 
-    def _parseLoginDef(self):
-        if not os.path.exists(self.loginDefFile):
-            raise PgsFormatError("%s is missing" % (self.loginDefFile))
-        buf = self._readFile(self.loginDefFile)
-
-        m = re.search("\\s*UID_MIN\s+([0-9]+)\\s*$", buf, re.M)
-        if m is not None:
-            self.uidMin = int(m.group(1))
-        else:
-            raise PgsFormatError("Invalid format of %s, UID_MIN is missing." % (self.loginDefFile))
+    @_writeLocked
+    def _commitAndKeepLock(self, keepLock):
+        assert self.valid
 
-        m = re.search("\\s*UID_MAX\s+([0-9]+)\\s*$", buf, re.M)
-        if m is not None:
-            self.uidMax = int(m.group(1))
-        else:
-            raise PgsFormatError("Invalid format of %s, UID_MAX is missing." % (self.loginDefFile))
+        if keepLock and self.lockFd is None:
+            # the lock is kept from now on, mutations needn't be recorded any more
+            self._lockPwd()
+            try:
+                self._commit()
+            except:
+                self._unlockPwd()
+                raise
+            self._fileDigestDict = None
+            self._mutationLog = None
+            self.optimistic = False
+            return
 
-        m = re.search("\\s*GID_MIN\s+([0-9]+)\\s*$", buf, re.M)
-        if m is not None:
-            self.gidMin = int(m.group(1))
-        else:
-            raise PgsFormatError("Invalid format of %s, GID_MIN is missing." % (self.loginDefFile))
+        self._commit()
+        if keepLock is False and self.lockFd is not None:
+            # changes made after this point are committed in optimistic mode
+            self._fileDigestDict = {x: self._fileDigest(x) for x in self._accountFileList()}
+            self._mutationLog = []
+            self.optimistic = True
+            self._unlockPwd()
 
-        m = re.search("\\s*GID_MAX\s+([0-9]+)\\s*$", buf, re.M)
-        if m is not None:
-            self.gidMax = int(m.group(1))
-        else:
-            raise PgsFormatError("Invalid format of %s, GID_MAX is missing." % (self.loginDefFile))
+    def _commit(self):
+        """lock is taken temporarily in optimistic mode"""
 
-        m = re.search("\\s*SUB_UID_MIN\s+([0-9]+)\\s*$", buf, re.M)
-        if m is not None:
-            self.subUidMin = int(m.group(1))
-        else:
-            raise PgsFormatError("Invalid format of %s, SUB_UID_MIN is missing, shadow version too low?" % (self.loginDefFile))
+        lockHere = (self.lockFd is None)
+        if lockHere:
+            self._lockPwd()
+        try:
+            if self.optimistic and self._isFileChanged():
+                self._replayMutations()
+            self._fixate()
+            self.backend.store(self)
 
-        m = re.search("\\s*SUB_UID_MAX\s+([0-9]+)\\s*$", buf, re.M)
-        if m is not None:
-            self.subUidMax = int(m.group(1))
-        else:
-            raise PgsFormatError("Invalid format of %s, SUB_UID_MAX is missing, shadow version too low?" % (self.loginDefFile))
+            # publish in the same order as the account files are written
+            if self.sharedModelFile is not None:
+                self._publishSharedModel(self.sharedModelFile)
+        finally:
+            if lockHere:
+                self._unlockPwd()
 
-        m = re.search("\\s*SUB_UID_COUNT\s+([0-9]+)\\s*$", buf, re.M)
-        if m is not None:
-            self.subUidCount = int(m.group(1))
-        else:
-            raise PgsFormatError("Invalid format of %s, SUB_UID_COUNT is missing, shadow version too low?" % (self.loginDefFile))
+        self._commitCount += 1
+        if self.optimistic:
+            self._mutationLog = []
+        if self.homeProvisioner is not None:
+            self._submitHomeChanges()
+
+    def _publishSharedModel(self, filename):
+        userList = []
+        for category, nameList in [("system", self.systemUserList), ("normal", self.normalUserList), ("software", self.softwareUserList), ("deprecated", self.deprecatedUserList)]:
+            for uname in nameList:
+                e = self.pwdDict[uname]
+                userList.append(PgsPwdRecord(category, e.pw_name, "x", e.pw_uid, e.pw_gid, e.pw_gecos, e.pw_dir, e.pw_shell))
+        groupList = []
+        for category, nameList in [("system", self.systemGroupList), ("per-user", self.perUserGroupList), ("stand-alone", self.standAloneGroupList),
+                                   ("device", self.deviceGroupList), ("software", self.softwareGroupList), ("deprecated", self.deprecatedGroupList)]:
+            for gname in nameList:
+                e = self.grpDict[gname]
+                groupList.append(PgsGrpRecord(category, e.gr_name, "x", e.gr_gid, e.gr_mem))
+        PgsSharedModel._publish(filename, userList, groupList)
+
+    def _getHomeDict(self):
+        return {x: self.pwdDict[x].pw_dir for x in self.normalUserList}
+
+    def _submitHomeChanges(self):
+        homeDict = self._getHomeDict()
+        addList = []
+        for uname in self.normalUserList:
+            if self._homeBaseDict.get(uname) != homeDict[uname]:
+                e = self.pwdDict[uname]
+                addList.append((uname, e.pw_dir, e.pw_uid, e.pw_gid))
+        usedHomeSet = set([os.path.normpath(x.pw_dir) for x in self.pwdDict.values()])
+        removeList = []
+        for uname, home in self._homeBaseDict.items():
+            if homeDict.get(uname) != home and os.path.normpath(home) not in usedHomeSet:
+                removeList.append((uname, home))
+        self.homeProvisioner.submit(self.dirPrefix, addList, removeList)
+        self._homeBaseDict = homeDict
+
+    def _hashPassword(self, password):
+        t = time.perf_counter()
+        ret = self._hashContext.encrypt(password)
+        self._addStats("hashCount", "hashTime", time.perf_counter() - t)
+        return ret
 
-        m = re.search("\\s*SUB_GID_MIN\s+([0-9]+)\\s*$", buf, re.M)
-        if m is not None:
-            self.subGidMin = int(m.group(1))
+    def _addStats(self, countKey, timeKey, elapsed):
+        with self._statsLock:
+            self._stats[countKey] += 1
+            self._stats[timeKey] += elapsed
+
+    def _getSubUidIndex(self):
+        if self._subUidIndex is None:
+            self._subUidIndex = _SubIdIndex(self.subUidDict)
+        return self._subUidIndex
+
+    def _getSubGidIndex(self):
+        if self._subGidIndex is None:
+            self._subGidIndex = _SubIdIndex(self.subGidDict)
+        return self._subGidIndex
+
+    def _cowEntry(self, theDict, key):
+        """returns theDict[key] which is safe to be modified in place, the value is copied first if it is shared with a snapshot"""
+        e = theDict[key]
+        if self._cowOwnedIdSet is not None and id(e) not in self._cowOwnedIdSet:
+            e = copy.copy(e)
+            theDict[key] = e
+            self._cowOwnedIdSet.add(id(e))
+        return e
+
+    def _retList(self, theList):
+        """list can't be shared with the caller in thread-safe mode"""
+        if self.threadSafe:
+            return list(theList)
         else:
-            raise PgsFormatError("Invalid format of %s, SUB_GID_MIN is missing, shadow version too low?" % (self.loginDefFile))
+            return theList
+
+    def _parseAll(self):
+        rowListDict = self.backend.load(self)
+        self._loadPasswd(rowListDict["passwd"])
+        self._loadGroup(rowListDict["group"], self.normalUserList)
+        self._loadShadow(rowListDict["shadow"])
+        self._loadSubUid(rowListDict["subuid"])
+        self._loadSubGid(rowListDict["subgid"])
+
+    def _accountFileList(self):
+        return [self.passwdFile, self.groupFile, self.shadowFile, self.subuidFile, self.subgidFile]
+
+    def _fileDigest(self, filename):
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'r') as f:
+            return hashlib.sha256(f.read().encode("utf-8")).digest()
 
-        m = re.search("\\s*SUB_GID_MAX\s+([0-9]+)\\s*$", buf, re.M)
-        if m is not None:
-            self.subGidMax = int(m.group(1))
-        else:
-            raise PgsFormatError("Invalid format of %s, SUB_GID_MAX is missing, shadow version too low?" % (self.loginDefFile))
+    def _isFileChanged(self):
+        for fn in self._accountFileList():
+            if self._fileDigestDict.get(fn) != self._fileDigest(fn):
+                return True
+        return False
 
-        m = re.search("\\s*SUB_GID_COUNT\s+([0-9]+)\\s*$", buf, re.M)
-        if m is not None:
-            self.subGidCount = int(m.group(1))
-        else:
-            raise PgsFormatError("Invalid format of %s, SUB_GID_COUNT is missing, shadow version too low?" % (self.loginDefFile))
+    def _replayMutations(self):
+        """re-parse the account files, then replay the recorded mutations on it
+           the in-memory model is restored if it fails, so that the next commit detects the change again"""
 
-        if self.uidMax < self.uidMin:
-            raise PgsFormatError("Invalid format of %s, UID_MAX is lesser than UID_MIN." % (self.loginDefFile))
+        # model containers are replaced instead of being modified, so saving the references is enough
+        savedDict = dict()
+        for attr in self._modelListAttrList + self._modelDictAttrList + ["_cowOwnedIdSet", "_fileDigestDict", "_homeBaseDict"]:
+            savedDict[attr] = getattr(self, attr)
 
-        if self.gidMax < self.gidMin:
-            raise PgsFormatError("Invalid format of %s, GID_MAX is lesser than GID_MIN." % (self.loginDefFile))
+        mutationLog = self._mutationLog
+        self._mutationLog = None
+        try:
+            for attr in self._modelListAttrList:
+                setattr(self, attr, [])
+            for attr in self._modelDictAttrList:
+                setattr(self, attr, dict())
+            self._subUidIndex = None
+            self._subGidIndex = None
+            self._cowOwnedIdSet = None
+            self._fileDigestDict = dict()
+            self._parseAll()
+            self._verifyStage1()
+            if self.homeProvisioner is not None:
+                self._homeBaseDict = self._getHomeDict()
+
+            for funcName, kargs in mutationLog:
+                errMsg = "Failed to replay %s for %s on changed account files" % (funcName.lstrip("_"), kargs[0])
+                if not self._isReplayable(funcName, kargs):
+                    raise PgsConflictError(errMsg)
+                try:
+                    getattr(self, funcName)(*kargs)
+                except Exception:
+                    raise PgsConflictError(errMsg)
+        except:
+            for attr, value in savedDict.items():
+                setattr(self, attr, value)
+            self._subUidIndex = None
+            self._subGidIndex = None
+            raise
+        finally:
+            self._mutationLog = mutationLog
+
+    def _isReplayable(self, funcName, kargs):
+        """mutations check their preconditions by assert, which is not enough for the changes made by others"""
+
+        if funcName == "_addNormalUser":
+            return kargs[0] not in self.pwdDict and kargs[0] not in self.grpDict
+        if funcName == "addStandAloneGroup":
+            return kargs[0] not in self.grpDict
+        if funcName in ["_setEncryptedPassword", "modifyNormalUser"]:
+            if kargs[0] not in self.normalUserList:
+                return False
+            if funcName == "modifyNormalUser" and kargs[1] == MUSER_JOIN_GROUP:
+                return kargs[2] in self.systemGroupList + self.deviceGroupList + self.standAloneGroupList + self.softwareGroupList
+            if funcName == "modifyNormalUser" and kargs[1] == MUSER_LEAVE_GROUP:
+                return kargs[2] in self.grpDict
+        return True
+
+    def _journal(self, funcName, *kargs):
+        if self._mutationLog is not None:
+            self._mutationLog.append((funcName, kargs))
 
-        if self.subUidMax < self.subUidMin:
-            raise PgsFormatError("Invalid format of %s, SUB_UID_MAX is lesser than SUB_UID_MIN." % (self.loginDefFile))
-        if (self.subUidMax - self.subUidMin) % self.subUidCount != 0:
-            raise PgsFormatError("Invalid format of %s, SUB_UID_MIN, SUB_UID_MAX and SUB_UID_COUNT is not aligned." % (self.loginDefFile))
+    def _parseLoginDef(self):
+        ld = self._readLoginDef(self.loginDefFile)
+        self.uidMin = ld["UID_MIN"]
+        self.uidMax = ld["UID_MAX"]
+        self.gidMin = ld["GID_MIN"]
+        self.gidMax = ld["GID_MAX"]
+        self.subUidMin = ld["SUB_UID_MIN"]
+        self.subUidMax = ld["SUB_UID_MAX"]
+        self.subUidCount = ld["SUB_UID_COUNT"]
+        self.subGidMin = ld["SUB_GID_MIN"]
+        self.subGidMax = ld["SUB_GID_MAX"]
+        self.subGidCount = ld["SUB_GID_COUNT"]
+        self.encryptMethod = ld["ENCRYPT_METHOD"]
+        self.shaCryptMinRounds = ld["SHA_CRYPT_MIN_ROUNDS"]
+        self.shaCryptMaxRounds = ld["SHA_CRYPT_MAX_ROUNDS"]
+
+    @classmethod
+    def _readLoginDef(cls, loginDefFile):
+        """returns a dict of login.defs items, key: item name; value: int, or str for ENCRYPT_METHOD
+           value of the optional items is None if they are missing"""
+
+        if not os.path.exists(loginDefFile):
+            raise PgsFormatError("%s is missing" % (loginDefFile))
+        with open(loginDefFile, "r") as f:
+            buf = f.read()
+
+        ret = dict()
+        for key in ["UID_MIN", "UID_MAX", "GID_MIN", "GID_MAX"]:
+            m = re.search("\\s*%s\\s+([0-9]+)\\s*$" % (key), buf, re.M)
+            if m is None:
+                raise PgsFormatError("Invalid format of %s, %s is missing." % (loginDefFile, key))
+            ret[key] = int(m.group(1))
+        for key in ["SUB_UID_MIN", "SUB_UID_MAX", "SUB_UID_COUNT", "SUB_GID_MIN", "SUB_GID_MAX", "SUB_GID_COUNT"]:
+            m = re.search("\\s*%s\\s+([0-9]+)\\s*$" % (key), buf, re.M)
+            if m is None:
+                raise PgsFormatError("Invalid format of %s, %s is missing, shadow version too low?" % (loginDefFile, key))
+            ret[key] = int(m.group(1))
+
+        m = re.search("\\s*ENCRYPT_METHOD\\s+(\\S+)\\s*$", buf, re.M)
+        ret["ENCRYPT_METHOD"] = m.group(1) if m is not None else None
+        for key in ["SHA_CRYPT_MIN_ROUNDS", "SHA_CRYPT_MAX_ROUNDS"]:
+            m = re.search("\\s*%s\\s+([0-9]+)\\s*$" % (key), buf, re.M)
+            ret[key] = int(m.group(1)) if m is not None else None
+
+        if ret["UID_MAX"] < ret["UID_MIN"]:
+            raise PgsFormatError("Invalid format of %s, UID_MAX is lesser than UID_MIN." % (loginDefFile))
+
+        if ret["GID_MAX"] < ret["GID_MIN"]:
+            raise PgsFormatError("Invalid format of %s, GID_MAX is lesser than GID_MIN." % (loginDefFile))
+
+        if ret["SUB_UID_MAX"] < ret["SUB_UID_MIN"]:
+            raise PgsFormatError("Invalid format of %s, SUB_UID_MAX is lesser than SUB_UID_MIN." % (loginDefFile))
+        if (ret["SUB_UID_MAX"] - ret["SUB_UID_MIN"]) % ret["SUB_UID_COUNT"] != 0:
+            raise PgsFormatError("Invalid format of %s, SUB_UID_MIN, SUB_UID_MAX and SUB_UID_COUNT is not aligned." % (loginDefFile))
+
+        if ret["SUB_GID_MAX"] < ret["SUB_GID_MIN"]:
+            raise PgsFormatError("Invalid format of %s, SUB_GID_MAX is lesser than SUB_GID_MIN." % (loginDefFile))
+        if (ret["SUB_GID_MAX"] - ret["SUB_GID_MIN"]) % ret["SUB_GID_COUNT"] != 0:
+            raise PgsFormatError("Invalid format of %s, SUB_GID_MIN, SUB_GID_MAX and SUB_GID_COUNT is not aligned." % (loginDefFile))
+
+        if ret["SHA_CRYPT_MIN_ROUNDS"] is not None and ret["SHA_CRYPT_MAX_ROUNDS"] is not None:
+            if ret["SHA_CRYPT_MAX_ROUNDS"] < ret["SHA_CRYPT_MIN_ROUNDS"]:
+                raise PgsFormatError("Invalid format of %s, SHA_CRYPT_MAX_ROUNDS is lesser than SHA_CRYPT_MIN_ROUNDS." % (loginDefFile))
 
-        if self.subGidMax < self.subGidMin:
-            raise PgsFormatError("Invalid format of %s, SUB_UID_MAX is lesser than SUB_UID_MIN." % (self.loginDefFile))
-        if (self.subGidMax - self.subGidMin) % self.subGidCount != 0:
-            raise PgsFormatError("Invalid format of %s, SUB_GID_MIN, SUB_GID_MAX and SUB_GID_COUNT is not aligned." % (self.loginDefFile))
+        return ret
 
-    def _parsePasswd(self):
-        lineList = self._readFile(self.passwdFile).split("\n")
-        for line in lineList:
-            if line == "" or line.startswith("#"):
-                continue
+    @classmethod
+    def _classifyUser(cls, username, uid, uidMin, uidMax):
+        """returns user category, one of: system, normal, deprecated, software"""
 
-            t = line.split(":")
-            if len(t) != 7:
-                raise PgsFormatError("Invalid format of passwd file")
+        if username in cls._stdSystemUserList:
+            return "system"
+        elif uidMin <= uid < uidMax:
+            return "normal"
+        elif username in cls._stdDeprecatedUserList:
+            return "deprecated"
+        else:
+            return "software"
+
+    @classmethod
+    def _classifyGroup(cls, groupname, gid, normalUserSet, gidMin, gidMax):
+        """returns group category, one of: system, per-user, device, deprecated, stand-alone, software"""
+
+        if groupname in cls._stdSystemGroupList:
+            return "system"
+        elif groupname in normalUserSet:
+            return "per-user"
+        elif groupname in cls._stdDeviceGroupList:
+            return "device"
+        elif groupname in cls._stdDeprecatedGroupList:
+            return "deprecated"
+        elif gidMin <= gid < gidMax:
+            return "stand-alone"
+        else:
+            return "software"
 
+    def _loadPasswd(self, rowList):
+        for t in rowList:
             self.pwdDict[t[0]] = self._PwdEntry(t)
 
-            if t[0] in self._stdSystemUserList:
+            category = self._classifyUser(t[0], int(t[2]), self.uidMin, self.uidMax)
+            if category == "system":
                 self.systemUserList.append(t[0])
-            elif self.uidMin <= int(t[2]) < self.uidMax:
+            elif category == "normal":
                 self.normalUserList.append(t[0])
-            elif t[0] in self._stdDeprecatedUserList:
+            elif category == "deprecated":
                 self.deprecatedUserList.append(t[0])
             else:
                 self.softwareUserList.append(t[0])
 
-    def _parseGroup(self, normalUserList):
-        lineList = self._readFile(self.groupFile).split("\n")
-        for line in lineList:
-            if line == "" or line.startswith("#"):
-                continue
-
-            t = line.split(":")
-            if len(t) != 4:
-                raise PgsFormatError("Invalid format of group file")
-
+    def _loadGroup(self, rowList, normalUserList):
+        for t in rowList:
             self.grpDict[t[0]] = self._GrpEntry(t)
 
-            if t[0] in self._stdSystemGroupList:
+            category = self._classifyGroup(t[0], int(t[2]), normalUserList, self.gidMin, self.gidMax)
+            if category == "system":
                 self.systemGroupList.append(t[0])
-            elif t[0] in normalUserList:
+            elif category == "per-user":
                 self.perUserGroupList.append(t[0])
-            elif t[0] in self._stdDeviceGroupList:
+            elif category == "device":
                 self.deviceGroupList.append(t[0])
-            elif t[0] in self._stdDeprecatedGroupList:
+            elif category == "deprecated":
                 self.deprecatedGroupList.append(t[0])
-            elif self.gidMin <= int(t[2]) < self.gidMax:
+            elif category == "stand-alone":
                 self.standAloneGroupList.append(t[0])
             else:
                 self.softwareGroupList.append(t[0])
@@ -565,131 +1538,92 @@ class PasswdGroupShadow:
                     self.secondaryGroupsDict[u] = []
                 self.secondaryGroupsDict[u].append(t[0])
 
-    def _parseShadow(self):
-        for line in self._readFile(self.shadowFile).split("\n"):
-            if line == "" or line.startswith("#"):
-                continue
-
-            t = line.split(":")
-            if len(t) != 9:
-                raise PgsFormatError("Invalid format of shadow file")
-
+    def _loadShadow(self, rowList):
+        for t in rowList:
             self.shDict[t[0]] = self._ShadowEntry(t)
             self.shadowEntryList.append(t[0])
 
-    def _parseSubUid(self):
-        if not os.path.exists(self.subuidFile):
+    def _loadSubUid(self, rowList):
+        if rowList is None:
             return
 
-        for line in self._readFile(self.subuidFile).split("\n"):
-            if line == "" or line.startswith("#"):
-                continue
-
-            t = line.split(":")
-            if len(t) != 3:
-                raise PgsFormatError("Invalid format of subuid file")
-
+        for t in rowList:
             self.subUidDict[t[0]] = self._SubUidGidEntry(t[0], int(t[1]), int(t[2]))
             self.subUidEntryList.append(t[0])
 
-    def _parseSubGid(self):
-        if not os.path.exists(self.subgidFile):
+    def _loadSubGid(self, rowList):
+        if rowList is None:
             return
 
-        for line in self._readFile(self.subgidFile).split("\n"):
-            if line == "" or line.startswith("#"):
-                continue
-
-            t = line.split(":")
-            if len(t) != 3:
-                raise PgsFormatError("Invalid format of subgid file")
-
+        for t in rowList:
             self.subGidDict[t[0]] = self._SubUidGidEntry(t[0], int(t[1]), int(t[2]))
             self.subGidEntryList.append(t[0])
 
-    def _writePasswd(self):
-        shutil.copy2(self.passwdFile, self.passwdFile + "-")
-        with open(self.passwdFile, "w") as f:
-            f.write(self.manageFlag + "\n")
-            f.write("\n")
-            for uname in self.systemUserList:
-                f.write(self._pwd2str(self.pwdDict[uname]))
-                f.write("\n")
-            f.write("\n")
-            for uname in self.normalUserList:
-                f.write(self._pwd2str(self.pwdDict[uname]))
-                f.write("\n")
-            f.write("\n")
-            for uname in self.softwareUserList:
-                f.write(self._pwd2str(self.pwdDict[uname]))
-                f.write("\n")
-            f.write("\n")
-            for uname in self.deprecatedUserList:
-                f.write(self._pwd2str(self.pwdDict[uname]))
-                f.write("\n")
-
-    def _writeGroup(self):
-        shutil.copy2(self.groupFile, self.groupFile + "-")
-        with open(self.groupFile, "w") as f:
-            f.write(self.manageFlag + "\n")
-            f.write("\n")
-            for gname in self.systemGroupList:
-                f.write(self._grp2str(self.grpDict[gname]))
-                f.write("\n")
-            f.write("\n")
-            for gname in self.perUserGroupList:
-                f.write(self._grp2str(self.grpDict[gname]))
-                f.write("\n")
-            f.write("\n")
-            for gname in self.standAloneGroupList:
-                f.write(self._grp2str(self.grpDict[gname]))
-                f.write("\n")
-            f.write("\n")
-            for gname in self.deviceGroupList:
-                f.write(self._grp2str(self.grpDict[gname]))
-                f.write("\n")
-            f.write("\n")
-            for gname in self.softwareGroupList:
-                f.write(self._grp2str(self.grpDict[gname]))
-                f.write("\n")
-            f.write("\n")
-            for gname in self.deprecatedGroupList:
-                f.write(self._grp2str(self.grpDict[gname]))
-                f.write("\n")
-
-    def _writeShadow(self):
-        shutil.copy2(self.shadowFile, self.shadowFile + "-")
-        with open(self.shadowFile, "w") as f:
-            f.write(self.manageFlag + "\n")
-            f.write("\n")
-            for sname in self.shadowEntryList:
-                f.write(self._sh2str(self.shDict[sname]))
-                f.write("\n")
-
-    def _writeGroupShadow(self):
-        shutil.copy2(self.gshadowFile, self.gshadowFile + "-")
-        with open(self.gshadowFile, "w") as f:
-            f.truncate()
-
-    def _writeSubUid(self):
-        if os.path.exists(self.subuidFile):
-            shutil.copy2(self.subuidFile, self.subuidFile + "-")
-        with open(self.subuidFile, "w") as f:
-            f.write(self.manageFlag + "\n")
-            f.write("\n")
-            for name in self.subUidEntryList:
-                f.write(self._subuidgid2str(self.subUidDict[name]))
-                f.write("\n")
-
-    def _writeSubGid(self):
-        if os.path.exists(self.subgidFile):
-            shutil.copy2(self.subgidFile, self.subgidFile + "-")
-        with open(self.subgidFile, "w") as f:
-            f.write(self.manageFlag + "\n")
-            f.write("\n")
-            for name in self.subGidEntryList:
-                f.write(self._subuidgid2str(self.subGidDict[name]))
-                f.write("\n")
+    def _genPasswd(self):
+        lineList = [self.manageFlag, ""]
+        lineList += [self._pwd2str(self.pwdDict[x]) for x in self.systemUserList]
+        lineList.append("")
+        lineList += [self._pwd2str(self.pwdDict[x]) for x in self.normalUserList]
+        lineList.append("")
+        lineList += [self._pwd2str(self.pwdDict[x]) for x in self.softwareUserList]
+        lineList.append("")
+        lineList += [self._pwd2str(self.pwdDict[x]) for x in self.deprecatedUserList]
+        return "\n".join(lineList) + "\n"
+
+    def _genGroup(self):
+        lineList = [self.manageFlag, ""]
+        lineList += [self._grp2str(self.grpDict[x]) for x in self.systemGroupList]
+        lineList.append("")
+        lineList += [self._grp2str(self.grpDict[x]) for x in self.perUserGroupList]
+        lineList.append("")
+        lineList += [self._grp2str(self.grpDict[x]) for x in self.standAloneGroupList]
+        lineList.append("")
+        lineList += [self._grp2str(self.grpDict[x]) for x in self.deviceGroupList]
+        lineList.append("")
+        lineList += [self._grp2str(self.grpDict[x]) for x in self.softwareGroupList]
+        lineList.append("")
+        lineList += [self._grp2str(self.grpDict[x]) for x in self.deprecatedGroupList]
+        return "\n".join(lineList) + "\n"
+
+    def _genShadow(self):
+        lineList = [self.manageFlag, ""]
+        lineList += [self._sh2str(self.shDict[x]) for x in self.shadowEntryList]
+        return "\n".join(lineList) + "\n"
+
+    def _genGroupShadow(self):
+        return ""
+
+    def _genSubUid(self):
+        lineList = [self.manageFlag, ""]
+        lineList += [self._subuidgid2str(self.subUidDict[x]) for x in self.subUidEntryList]
+        return "\n".join(lineList) + "\n"
+
+    def _genSubGid(self):
+        lineList = [self.manageFlag, ""]
+        lineList += [self._subuidgid2str(self.subGidDict[x]) for x in self.subGidEntryList]
+        return "\n".join(lineList) + "\n"
+
+    def _genAll(self):
+        return [
+            (self.passwdFile, self._genPasswd()),
+            (self.groupFile, self._genGroup()),
+            (self.shadowFile, self._genShadow()),
+            (self.gshadowFile, self._genGroupShadow()),
+            (self.subuidFile, self._genSubUid()),
+            (self.subgidFile, self._genSubGid()),
+        ]
+
+    def _writeAll(self, fileList=None):
+        if fileList is None:
+            fileList = self._genAll()
+        if len(fileList) == 0:
+            return
+        self._writeFiles(fileList)
+
+        # so that our own writing is not regarded as change by others
+        if self._fileDigestDict is not None:
+            for fn, content in fileList:
+                self._fileDigestDict[fn] = hashlib.sha256(content.encode("utf-8")).digest()
 
     def _pwd2str(self, e):
         return "%s:%s:%d:%d:%s:%s:%s" % (e.pw_name, "x", e.pw_uid, e.pw_gid, e.pw_gecos, e.pw_dir, e.pw_shell)
@@ -717,12 +1651,14 @@ class PasswdGroupShadow:
         for uname in self.normalUserList:
             if not (self.uidMin <= self.pwdDict[uname].pw_uid < self.uidMax):
                 raise PgsFormatError("User ID out of range for normal user %s" % (uname))
+            if uname not in self.grpDict:
+                raise PgsFormatError("No per-user group for normal user %s" % (uname))
             if self.pwdDict[uname].pw_uid != self.grpDict[uname].gr_gid:
                 raise PgsFormatError("User ID and group ID not equal for normal user %s" % (uname))
-            if len(self.shDict[uname].sh_encpwd) <= 4:
-                raise PgsFormatError("No password for normal user %s" % (uname))
             if uname not in self.shDict:
                 raise PgsFormatError("No shadow entry for normal user %s" % (uname))
+            if len(self.shDict[uname].sh_encpwd) <= 4:
+                raise PgsFormatError("No password for normal user %s" % (uname))
 
         # check system group list
         if set(self.systemGroupList) != set(self._stdSystemGroupList):
@@ -827,6 +1763,11 @@ class PasswdGroupShadow:
             if obj.count != self.subUidCount:
                 raise PgsFormatError("Subordinate User ID count is different from %s for user %s" % (self.loginDefFile, uname))
 
+        # check subuid range overlap
+        overlapList = self._getSubUidIndex().findOverlaps()
+        if len(overlapList) > 0:
+            raise PgsFormatError("Subordinate User ID range overlaps: %s" % (", ".join(["%s and %s" % (x, y) for x, y in overlapList])))
+
         # check subgid entry list
         if self.subUidEntryList != self.subGidEntryList:
             raise PgsFormatError("Invalid subgid file entries")
@@ -840,25 +1781,36 @@ class PasswdGroupShadow:
             if obj.count != self.subGidCount:
                 raise PgsFormatError("Subordinate Group ID count is different from %s for user %s" % (self.loginDefFile, uname))
 
+        # check subgid range overlap
+        overlapList = self._getSubGidIndex().findOverlaps()
+        if len(overlapList) > 0:
+            raise PgsFormatError("Subordinate Group ID range overlaps: %s" % (", ".join(["%s and %s" % (x, y) for x, y in overlapList])))
+
     def _fixate(self):
+        self._subUidIndex = None
+        self._subGidIndex = None
+
         # sort system user list
         assert set(self.systemUserList) == set(self._stdSystemUserList)
-        self.systemUserList = self._stdSystemUserList
+        self.systemUserList = list(self._stdSystemUserList)
 
         # remove comment for system users
         for uname in self.systemUserList:
-            self.pwdDict[uname].pw_gecos = ""
+            if self.pwdDict[uname].pw_gecos != "":
+                self._cowEntry(self.pwdDict, uname).pw_gecos = ""
 
         # sort normal user list
         self.normalUserList.sort(key=lambda x: self.pwdDict[x].pw_uid)
 
         # remove comment for normal users
         for uname in self.normalUserList:
-            self.pwdDict[uname].pw_gecos = ""
+            if self.pwdDict[uname].pw_gecos != "":
+                self._cowEntry(self.pwdDict, uname).pw_gecos = ""
 
         # standardize shell for software users
         for uname in self.softwareUserList:
-            self.pwdDict[uname].pw_shell = "/sbin/nologin"
+            if self.pwdDict[uname].pw_shell != "/sbin/nologin":
+                self._cowEntry(self.pwdDict, uname).pw_shell = "/sbin/nologin"
 
         # remove shadow entry for software users
         for uname in self.softwareUserList:
@@ -867,28 +1819,29 @@ class PasswdGroupShadow:
 
         # sort system group list
         assert set(self.systemGroupList) == set(self._stdSystemGroupList)
-        self.systemGroupList = self._stdSystemGroupList
+        self.systemGroupList = list(self._stdSystemGroupList)
 
         # sort per-user group list
         assert set(self.perUserGroupList) == set(self.normalUserList)
-        self.perUserGroupList = self.normalUserList
+        self.perUserGroupList = list(self.normalUserList)
 
         # sort stand-alone group list
-        self.standAloneGroupList.sort(key=lambda x: self.grpDict[x].pw_gid)
+        self.standAloneGroupList.sort(key=lambda x: self.grpDict[x].gr_gid)
 
         # remove root from any secondary group
         if "root" in self.secondaryGroupsDict:
             del self.secondaryGroupsDict["root"]
-        for entry in self.grpDict.values():
+        for gname, entry in self.grpDict.items():
             ulist = [x for x in entry.gr_mem.split(",") if x != ""]
             if "root" in ulist:
                 ulist.remove("root")
-                entry.gr_mem = ",".join(ulist)
+                self._cowEntry(self.grpDict, gname).gr_mem = ",".join(ulist)
 
         # standardize group members
-        for g in self.grpDict.values():
+        for gname, g in self.grpDict.items():
             ulist = [x for x in g.gr_mem.split(",") if x != ""]
-            g.gr_mem = ",".join(ulist)
+            if g.gr_mem != ",".join(ulist):
+                self._cowEntry(self.grpDict, gname).gr_mem = ",".join(ulist)
 
         # sort shadow entry list
         assert set(self.shadowEntryList) >= set(self.systemUserList + self.normalUserList)
@@ -943,7 +1896,51 @@ class PasswdGroupShadow:
         """Read file, returns the whole content"""
 
         with open(filename, 'r') as f:
-            return f.read()
+            buf = f.read()
+        if self._fileDigestDict is not None and filename not in self._fileDigestDict:
+            self._fileDigestDict[filename] = hashlib.sha256(buf.encode("utf-8")).digest()
+        return buf
+
+    def _readFiles(self, filenameList):
+        """Read files concurrently, returns dict, key: filename; value: content, None if the file doesn't exist"""
+
+        def _read(filename):
+            if not os.path.exists(filename):
+                return None
+            return self._readFile(filename)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(filenameList)) as executor:
+            return dict(zip(filenameList, executor.map(_read, filenameList)))
+
+    def _writeFiles(self, fileList):
+        """Write files, fileList is [(filename, content)]
+           Backup of old files and writing of new files are done concurrently, new files are
+           then renamed into place one by one, in the order of fileList"""
+
+        def _write(filename, content):
+            if os.path.exists(filename):
+                shutil.copy2(filename, filename + "-")
+                st = os.stat(filename)
+                mode, uid, gid = (st.st_mode & 0o7777, st.st_uid, st.st_gid)
+            else:
+                mode, uid, gid = (0o644, None, None)
+
+            tmpFile = filename + "+"
+            fd = os.open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, mode)
+            with open(fd, "w") as f:
+                if uid is not None:
+                    os.fchown(fd, uid, gid)
+                os.fchmod(fd, mode)
+                f.write(content)
+                f.flush()
+                os.fsync(fd)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(fileList)) as executor:
+            for future in [executor.submit(_write, fn, content) for fn, content in fileList]:
+                future.result()
+
+        for fn, content in fileList:
+            os.rename(fn + "+", fn)
 
     def _lockPwd(self):
         """Use the same implementation as lckpwdf() in glibc"""
@@ -951,13 +1948,13 @@ class PasswdGroupShadow:
         assert self.lockFd is None
         self.lockFd = os.open(self.lockFile, os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC, 0o600)
         try:
-            t = time.clock()
-            while time.clock() - t < 15.0:
+            t = time.monotonic()
+            while time.monotonic() - t < 15.0:
                 try:
                     fcntl.lockf(self.lockFd, fcntl.LOCK_EX | fcntl.LOCK_NB)
                     return
                 except IOError as e:
-                    if e.errno != errno.EACCESS and e.errno != errno.EAGAIN:
+                    if e.errno != errno.EACCES and e.errno != errno.EAGAIN:
                         raise
                 time.sleep(1.0)
             raise PgsLockError("Failed to acquire lock")
@@ -972,3 +1969,936 @@ class PasswdGroupShadow:
         assert self.lockFd is not None
         os.close(self.lockFd)
         self.lockFd = None
+
+
+class PgsFlatFileBackend:
+
+    """Account data is stored in the flat files, it is the default backend of PasswdGroupShadow."""
+
+    def load(self, pgs):
+        """returns dict, key: "passwd", "group", "shadow", "subuid" or "subgid"; value: list of field lists
+           value is None for subuid and subgid if the file doesn't exist"""
+
+        # the files are independent, read them concurrently
+        bufDict = pgs._readFiles(pgs._accountFileList())
+
+        ret = dict()
+        for key, filename, fieldNum in [("passwd", pgs.passwdFile, 7), ("group", pgs.groupFile, 4), ("shadow", pgs.shadowFile, 9),
+                                        ("subuid", pgs.subuidFile, 3), ("subgid", pgs.subgidFile, 3)]:
+            if bufDict[filename] is not None:
+                ret[key] = _splitAccountFile(bufDict[filename], fieldNum, key)
+            elif key in ["subuid", "subgid"]:
+                ret[key] = None
+            else:
+                raise PgsFormatError("%s is missing" % (filename))
+        return ret
+
+    def store(self, pgs):
+        """write the in-memory model of pgs"""
+        pgs._writeAll()
+
+
+class PgsSqliteBackend:
+
+    """Account data is stored in an SQLite database, the flat files are exported from it.
+       The database is initialized from the flat files if it is empty. Flat files are
+       exported incrementally, only the changed ones are rewritten.
+       Digests of the exported files are kept in the database, the flat files are imported again
+       if they are changed by others, so that changes made without this backend are not lost.
+       Users, groups and memberships can be looked up through indexes by the get*() methods,
+       without loading the whole model.
+       Rows are ordered by a sparse pos column, so adding or removing one entry doesn't move the others.
+       A backend object serves only one PasswdGroupShadow object at a time.
+    """
+
+    _schema = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS passwd (name TEXT PRIMARY KEY, passwd TEXT, uid INTEGER, gid INTEGER, gecos TEXT, dir TEXT, shell TEXT, category TEXT, pos INTEGER);
+        CREATE INDEX IF NOT EXISTS passwd_uid ON passwd (uid);
+        CREATE TABLE IF NOT EXISTS grp (name TEXT PRIMARY KEY, passwd TEXT, gid INTEGER, mem TEXT, category TEXT, pos INTEGER);
+        CREATE INDEX IF NOT EXISTS grp_gid ON grp (gid);
+        CREATE TABLE IF NOT EXISTS member (user TEXT, grp TEXT, PRIMARY KEY (user, grp));
+        CREATE INDEX IF NOT EXISTS member_grp ON member (grp);
+        CREATE TABLE IF NOT EXISTS shadow (name TEXT PRIMARY KEY, encpwd TEXT, pos INTEGER);
+        CREATE TABLE IF NOT EXISTS subuid (name TEXT PRIMARY KEY, start INTEGER, count INTEGER, pos INTEGER);
+        CREATE TABLE IF NOT EXISTS subgid (name TEXT PRIMARY KEY, start INTEGER, count INTEGER, pos INTEGER);
+    """
+
+    _columnDict = {
+        "passwd": ["name", "passwd", "uid", "gid", "gecos", "dir", "shell", "category", "pos"],
+        "grp": ["name", "passwd", "gid", "mem", "category", "pos"],
+        "shadow": ["name", "encpwd", "pos"],
+        "subuid": ["name", "start", "count", "pos"],
+        "subgid": ["name", "start", "count", "pos"],
+    }
+
+    _posStep = 1 << 16                  # distance of pos between adjacent rows when they are numbered
+
+    def __init__(self, dbFile):
+        self.dbFile = dbFile
+        self._conn = sqlite3.connect(dbFile, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript(self._schema)
+            self._conn.commit()
+        self._loadedRowDict = None      # key: table name; value: dict, key: name; value: row tuple
+        self._loadedDigestDict = None   # key: filename; value: digest of the flat file when loaded
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def getUser(self, username):
+        """returns PgsPwdRecord, None if not found"""
+        return self._queryUser("WHERE name = ?", username)
+
+    def getUserByUid(self, uid):
+        """returns PgsPwdRecord, None if not found"""
+        return self._queryUser("WHERE uid = ? ORDER BY pos", uid)
+
+    def getGroup(self, groupname):
+        """returns PgsGrpRecord, None if not found"""
+        return self._queryGroup("WHERE name = ?", groupname)
+
+    def getGroupByGid(self, gid):
+        """returns PgsGrpRecord, None if not found"""
+        return self._queryGroup("WHERE gid = ? ORDER BY pos", gid)
+
+    def getSecondaryGroupsOfUser(self, username):
+        """returns group name list"""
+        with self._lock:
+            return [x[0] for x in self._conn.execute("SELECT grp FROM member WHERE user = ? ORDER BY grp", (username,))]
+
+    def load(self, pgs):
+        """same as PgsFlatFileBackend.load()"""
+
+        self._loadedDigestDict = self._getFileDigestDict(pgs)
+        with self._lock:
+            metaDict = dict(self._conn.execute("SELECT key, value FROM meta").fetchall())
+
+        if metaDict.get("initialized") is None:
+            # all the rows are written by the first store()
+            self._loadedRowDict = None
+            return PgsFlatFileBackend().load(pgs)
+
+        self._loadedRowDict = dict()
+        with self._lock:
+            for table in self._columnDict:
+                sql = "SELECT %s FROM %s ORDER BY pos" % (", ".join(self._columnDict[table]), table)
+                self._loadedRowDict[table] = collections.OrderedDict([(x[0], tuple(x)) for x in self._conn.execute(sql)])
+
+        for fn, digest in self._loadedDigestDict.items():
+            if metaDict.get("digest:" + os.path.basename(fn)) != digest:
+                # flat files are changed by others, import them, changed rows are written by the next store()
+                return PgsFlatFileBackend().load(pgs)
+
+        # for change detection in optimistic mode
+        if pgs._fileDigestDict is not None:
+            for fn in pgs._accountFileList():
+                pgs._fileDigestDict[fn] = pgs._fileDigest(fn)
+
+        ret = dict()
+        ret["passwd"] = [[str(x) for x in r[:7]] for r in self._loadedRowDict["passwd"].values()]
+        ret["group"] = [[str(x) for x in r[:4]] for r in self._loadedRowDict["grp"].values()]
+        ret["shadow"] = [[r[0], r[1], "", "", "", "", "", "", ""] for r in self._loadedRowDict["shadow"].values()]
+        ret["subuid"] = [[str(x) for x in r[:3]] for r in self._loadedRowDict["subuid"].values()]
+        ret["subgid"] = [[str(x) for x in r[:3]] for r in self._loadedRowDict["subgid"].values()]
+        return ret
+
+    def store(self, pgs):
+        """export the changed flat files, then write the changed rows of the in-memory model of pgs into the database
+           raises PgsConflictError if the flat files are changed by others after load"""
+
+        if self._getFileDigestDict(pgs) != self._loadedDigestDict:
+            raise PgsConflictError("Account files are changed by others")
+
+        # export first, so that the database is never ahead of the flat files
+        newRowDict = self._getModelRowDict(pgs)
+        genList = pgs._genAll()
+        fileList = []
+        for fn, content in genList:
+            if pgs._fileDigest(fn) != hashlib.sha256(content.encode("utf-8")).digest():
+                fileList.append((fn, content))
+        pgs._writeAll(fileList)
+
+        accountFileSet = set(pgs._accountFileList())
+        digestDict = {fn: hashlib.sha256(content.encode("utf-8")).hexdigest() for fn, content in genList if fn in accountFileSet}
+
+        with self._lock:
+            with self._conn:
+                for table, columnList in self._columnDict.items():
+                    if self._loadedRowDict is not None:
+                        oldRows = self._loadedRowDict[table]
+                    else:
+                        self._conn.execute("DELETE FROM %s" % (table))
+                        oldRows = dict()
+                    newRows = newRowDict[table]
+
+                    for name in set(oldRows.keys()) - set(newRows.keys()):
+                        self._conn.execute("DELETE FROM %s WHERE name = ?" % (table), (name,))
+                        if table == "grp":
+                            self._conn.execute("DELETE FROM member WHERE grp = ?", (name,))
+
+                    sql = "INSERT OR REPLACE INTO %s (%s) VALUES (%s)" % (table, ", ".join(columnList), ", ".join(["?"] * len(columnList)))
+                    for name, row in newRows.items():
+                        if oldRows.get(name) == row:
+                            continue
+                        self._conn.execute(sql, row)
+                        if table == "grp" and (name not in oldRows or oldRows[name][3] != row[3]):
+                            self._conn.execute("DELETE FROM member WHERE grp = ?", (name,))
+                            self._conn.executemany("INSERT OR IGNORE INTO member (user, grp) VALUES (?, ?)",
+                                                   [(x, name) for x in row[3].split(",") if x != ""])
+                if self._loadedRowDict is None:
+                    self._conn.execute("DELETE FROM member WHERE grp NOT IN (SELECT name FROM grp)")
+                for fn, digest in digestDict.items():
+                    self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", ("digest:" + os.path.basename(fn), digest))
+                self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('initialized', '1')")
+        self._loadedRowDict = newRowDict
+        self._loadedDigestDict = digestDict
+
+    def _getFileDigestDict(self, pgs):
+        ret = dict()
+        for fn in pgs._accountFileList():
+            digest = pgs._fileDigest(fn)
+            ret[fn] = digest.hex() if digest is not None else ""
+        return ret
+
+    def _getModelRowDict(self, pgs):
+        ret = dict()
+
+        rowList = []
+        for category, nameList in [("system", pgs.systemUserList), ("normal", pgs.normalUserList), ("software", pgs.softwareUserList), ("deprecated", pgs.deprecatedUserList)]:
+            for uname in nameList:
+                e = pgs.pwdDict[uname]
+                rowList.append((e.pw_name, "x", e.pw_uid, e.pw_gid, e.pw_gecos, e.pw_dir, e.pw_shell, category))
+        ret["passwd"] = self._addPos("passwd", rowList)
+
+        rowList = []
+        for category, nameList in [("system", pgs.systemGroupList), ("per-user", pgs.perUserGroupList), ("stand-alone", pgs.standAloneGroupList),
+                                   ("device", pgs.deviceGroupList), ("software", pgs.softwareGroupList), ("deprecated", pgs.deprecatedGroupList)]:
+            for gname in nameList:
+                e = pgs.grpDict[gname]
+                rowList.append((e.gr_name, "x", e.gr_gid, e.gr_mem, category))
+        ret["grp"] = self._addPos("grp", rowList)
+
+        rowList = [(x, pgs.shDict[x].sh_encpwd) for x in pgs.shadowEntryList]
+        ret["shadow"] = self._addPos("shadow", rowList)
+
+        for table, entryList, entryDict in [("subuid", pgs.subUidEntryList, pgs.subUidDict), ("subgid", pgs.subGidEntryList, pgs.subGidDict)]:
+            rowList = [(x, entryDict[x].start, entryDict[x].count) for x in entryList]
+            ret[table] = self._addPos(table, rowList)
+
+        return ret
+
+    def _addPos(self, table, rowList):
+        """returns OrderedDict, key: name; value: row with pos column appended
+           pos is sparse, rows keep their loaded pos as long as the order allows, so that a point change rewrites only a few rows"""
+
+        posList = [None] * len(rowList)
+        if self._loadedRowDict is not None:
+            oldRows = self._loadedRowDict[table]
+            oldPosList = [oldRows[r[0]][-1] if r[0] in oldRows else None for r in rowList]
+            for i in self._longestIncreasing(oldPosList):
+                posList[i] = oldPosList[i]
+
+        # new or moved rows are put evenly into the gap between their neighbours
+        i = 0
+        while i < len(rowList):
+            if posList[i] is not None:
+                i += 1
+                continue
+            j = i
+            while j < len(rowList) and posList[j] is None:
+                j += 1
+            lo = posList[i - 1] if i > 0 else 0
+            if j < len(rowList):
+                step = (posList[j] - lo) // (j - i + 1)
+            else:
+                step = self._posStep
+            if step == 0:
+                # no room, re-number all the rows
+                posList = [(k + 1) * self._posStep for k in range(0, len(rowList))]
+                break
+            for k in range(i, j):
+                posList[k] = lo + (k - i + 1) * step
+            i = j
+
+        return collections.OrderedDict([(r[0], r + (pos,)) for r, pos in zip(rowList, posList)])
+
+    @staticmethod
+    def _longestIncreasing(valueList):
+        """returns index list of the longest strictly increasing subsequence of valueList, None values are skipped, O(n log n)"""
+
+        tailValueList = []      # tailValueList[k]: smallest tail value of the increasing subsequences of length k + 1
+        tailIndexList = []
+        prevIndexList = [None] * len(valueList)
+        for i, v in enumerate(valueList):
+            if v is None:
+                continue
+            k = bisect.bisect_left(tailValueList, v)
+            prevIndexList[i] = tailIndexList[k - 1] if k > 0 else None
+            if k == len(tailValueList):
+                tailValueList.append(v)
+                tailIndexList.append(i)
+            else:
+                tailValueList[k] = v
+                tailIndexList[k] = i
+
+        ret = []
+        i = tailIndexList[-1] if len(tailIndexList) > 0 else None
+        while i is not None:
+            ret.append(i)
+            i = prevIndexList[i]
+        ret.reverse()
+        return ret
+
+    def _queryUser(self, cond, value):
+        with self._lock:
+            r = self._conn.execute("SELECT category, name, passwd, uid, gid, gecos, dir, shell FROM passwd " + cond, (value,)).fetchone()
+        return PgsPwdRecord(*r) if r is not None else None
+
+    def _queryGroup(self, cond, value):
+        with self._lock:
+            r = self._conn.execute("SELECT category, name, passwd, gid, mem FROM grp " + cond, (value,)).fetchone()
+        return PgsGrpRecord(*r) if r is not None else None
+
+
+class PgsHomeProvisioner:
+
+    """Creates home directories for new normal users and archives home directories of removed normal users.
+       PasswdGroupShadow submits the tasks after the account files are committed successfully, tasks are run
+       in a bounded worker pool so that close() returns quickly.
+       One object can be shared by many PasswdGroupShadow objects.
+    """
+
+    def __init__(self, maxWorkers=4, skelDir="/etc/skel", archiveDir="/var/backups/home", homeBaseDir="/home"):
+        """skelDir, archiveDir and homeBaseDir are relative to the dirPrefix of PasswdGroupShadow
+           only home directories under homeBaseDir are archived and removed"""
+        self.skelDir = skelDir
+        self.archiveDir = archiveDir
+        self.homeBaseDir = homeBaseDir
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers)
+        self._futureList = []
+        self._lock = threading.Lock()
+
+    def submit(self, dirPrefix, addList, removeList):
+        """addList: list of (username, pw_dir, uid, gid) whose home directory should be created
+           removeList: list of (username, pw_dir) whose home directory should be archived then removed, it must not be used by other users
+           returns list of futures, result of the future is the username"""
+        ret = []
+        for uname, home in removeList:
+            ret.append(self._executor.submit(self._deprovision, dirPrefix, uname, home))
+        for uname, home, uid, gid in addList:
+            ret.append(self._executor.submit(self._provision, dirPrefix, uname, home, uid, gid))
+        with self._lock:
+            self._futureList += ret
+        return ret
+
+    def getFutureList(self):
+        with self._lock:
+            return list(self._futureList)
+
+    def getProgress(self):
+        """returns (finished task count, total task count)"""
+        with self._lock:
+            return (len([x for x in self._futureList if x.done()]), len(self._futureList))
+
+    def wait(self, timeout=None):
+        """wait for all the submitted tasks, returns the futures that are not finished yet"""
+        done, notDone = concurrent.futures.wait(self.getFutureList(), timeout=timeout)
+        return list(notDone)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _provision(self, dirPrefix, uname, home, uid, gid):
+        homePath = os.path.join(dirPrefix, home.lstrip("/"))
+        if os.path.exists(homePath):
+            return uname
+
+        skelPath = os.path.join(dirPrefix, self.skelDir.lstrip("/"))
+        if os.path.isdir(skelPath):
+            shutil.copytree(skelPath, homePath, symlinks=True)
+        else:
+            os.makedirs(homePath)
+        os.chmod(homePath, 0o700)
+
+        os.lchown(homePath, uid, gid)
+        for root, dirs, files in os.walk(homePath):
+            for f in dirs + files:
+                os.lchown(os.path.join(root, f), uid, gid)
+        return uname
+
+    def _deprovision(self, dirPrefix, uname, home):
+        homePath = os.path.realpath(os.path.join(dirPrefix, home.lstrip("/")))
+        if not os.path.isdir(homePath):
+            return uname
+
+        # never remove anything outside of home base directory, or home base directory itself
+        basePath = os.path.realpath(os.path.join(dirPrefix, self.homeBaseDir.lstrip("/")))
+        if homePath == basePath or os.path.commonpath([homePath, basePath]) != basePath:
+            return uname
+
+        archivePath = os.path.join(dirPrefix, self.archiveDir.lstrip("/"))
+        os.makedirs(archivePath, exist_ok=True)
+        basename = os.path.join(archivePath, "%s-%s" % (uname, time.strftime("%Y%m%d%H%M%S")))
+        shutil.make_archive(basename, "gztar", root_dir=homePath)
+        shutil.rmtree(homePath)
+        return uname
+
+
+class PgsChownWalker:
+
+    """Rewrites ownership of files under some directories according to uid and gid maps.
+       Directories are scanned in parallel, symbolic links are not followed and mount points are not crossed.
+       If stateFile is specified, directories whose sub-tree is completely processed are recorded in it,
+       an interrupted run is resumed by running again with the same stateFile.
+    """
+
+    class _Node:
+
+        def __init__(self, path, parent, dev):
+            self.path = path
+            self.parent = parent
+            self.dev = dev
+            self.pending = 1
+            self.failed = False
+
+    def __init__(self, uidMap, gidMap, maxWorkers=8, stateFile=None):
+        """uidMap and gidMap are dicts, key: old ID; value: new ID
+           new IDs must not be old IDs, so that processing a file twice does no harm"""
+        for m in [uidMap, gidMap]:
+            if len(set(m.keys()) & set(m.values())) > 0:
+                raise ValueError("New ID can not be an old ID")
+        self.uidMap = uidMap
+        self.gidMap = gidMap
+        self.maxWorkers = maxWorkers
+        self.stateFile = stateFile
+
+        self._lock = threading.Lock()
+        self._progress = {
+            "dirCount": 0,
+            "fileCount": 0,
+            "changeCount": 0,
+        }
+
+    def getProgress(self):
+        """returns progress dict
+           dirCount:    number of directories scanned
+           fileCount:   number of files (including directories) checked
+           changeCount: number of files whose ownership is changed"""
+        with self._lock:
+            return dict(self._progress)
+
+    def run(self, rootList, progressCallback=None):
+        """process the directories in rootList, progressCallback(progressDict) is called after each directory is scanned"""
+
+        self._doneSet = set()
+        if self.stateFile is not None and os.path.exists(self.stateFile):
+            with open(self.stateFile, "r") as f:
+                self._doneSet = set([x.rstrip("\n") for x in f if x != "\n"])
+        self._stateFileObj = open(self.stateFile, "a") if self.stateFile is not None else None
+        self._progressCallback = progressCallback
+        self._error = None
+        self._allDone = threading.Event()
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+                self._executor = executor
+                top = self._Node(None, None, None)
+                for root in rootList:
+                    root = os.path.abspath(root)
+                    if root in self._doneSet:
+                        continue
+                    st = os.lstat(root)
+                    self._chown(root, st)
+                    top.pending += 1
+                    executor.submit(self._process, self._Node(root, top, st.st_dev))
+                self._finish(top)
+                self._allDone.wait()
+                self._executor = None
+        finally:
+            if self._stateFileObj is not None:
+                self._stateFileObj.close()
+                self._stateFileObj = None
+
+        if self._error is not None:
+            raise self._error
+
+    def _process(self, node):
+        try:
+            subDirList = []
+            fileCount = 0
+            changeCount = 0
+            with os.scandir(node.path) as it:
+                for entry in it:
+                    st = entry.stat(follow_symlinks=False)
+                    if st.st_dev != node.dev:
+                        continue
+                    fileCount += 1
+                    if self._chown(entry.path, st):
+                        changeCount += 1
+                    if stat.S_ISDIR(st.st_mode) and entry.path not in self._doneSet:
+                        subDirList.append(entry.path)
+
+            with self._lock:
+                node.pending += len(subDirList)
+                self._progress["dirCount"] += 1
+                self._progress["fileCount"] += fileCount
+                self._progress["changeCount"] += changeCount
+            for path in subDirList:
+                self._executor.submit(self._process, self._Node(path, node, node.dev))
+            if self._progressCallback is not None:
+                self._progressCallback(self.getProgress())
+        except Exception as e:
+            with self._lock:
+                node.failed = True
+                if self._error is None:
+                    self._error = e
+        finally:
+            self._finish(node)
+
+    def _finish(self, node):
+        with self._lock:
+            while node is not None:
+                node.pending -= 1
+                if node.pending > 0:
+                    break
+                if node.parent is None:
+                    self._allDone.set()
+                    break
+                if node.failed:
+                    node.parent.failed = True
+                elif self._stateFileObj is not None:
+                    self._stateFileObj.write(node.path + "\n")
+                    self._stateFileObj.flush()
+                node = node.parent
+
+    def _chown(self, path, st):
+        uid = self.uidMap.get(st.st_uid, -1)
+        gid = self.gidMap.get(st.st_gid, -1)
+        if uid == -1 and gid == -1:
+            return False
+        os.lchown(path, uid, gid)
+        if not stat.S_ISLNK(st.st_mode) and st.st_mode & (stat.S_ISUID | stat.S_ISGID) != 0:
+            # chown() clears set-user-ID and set-group-ID bits
+            os.chmod(path, stat.S_IMODE(st.st_mode))
+        return True
+
+
+class PgsSharedModel:
+
+    """Read-only model published by PasswdGroupShadow.publishSharedModel().
+       The file is memory-mapped and looked up in place, so all the processes on a host share one copy of it.
+       Publisher replaces the file atomically with a new generation, call refresh() to attach to it.
+
+       File layout, all integers are little-endian:
+           header
+           user table, sorted by name
+           user index, sorted by uid
+           group table, sorted by name
+           group index, sorted by gid
+           member table, sorted by user name
+           string area
+    """
+
+    _magic = b"PGSM"
+    _formatVersion = 1
+    _header = struct.Struct("<4sIQIII")             # magic, format version, generation, user count, group count, member count
+    _userRecord = struct.Struct("<IIIIIIIIIIB")     # name, uid, gid, gecos, dir, shell, category; strings are (offset, length)
+    _groupRecord = struct.Struct("<IIIIIB")         # name, gid, members, category
+    _memberRecord = struct.Struct("<III")           # user name, group record index
+    _index = struct.Struct("<I")                    # record index
+
+    _userCategoryList = ["system", "normal", "software", "deprecated"]
+    _groupCategoryList = ["system", "per-user", "stand-alone", "device", "software", "deprecated"]
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._f = None
+        self._mm = None
+        self._attach()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self._detach()
+
+    def getGeneration(self):
+        return self._generation
+
+    def refresh(self):
+        """attach to the latest generation, returns True if generation changes"""
+        st = os.stat(self.filename)
+        if (st.st_dev, st.st_ino) == self._fileId:
+            return False
+        self._detach()
+        self._attach()
+        return True
+
+    def getUser(self, username):
+        """returns PgsPwdRecord, None if not found"""
+        i = self._findByName(self._userOff, self._userRecord, self._userCount, username)
+        return self._userAt(i) if i is not None else None
+
+    def getUserByUid(self, uid):
+        """returns PgsPwdRecord, None if not found"""
+        i = self._findById(self._userIndexOff, self._userCount, self._userOff, self._userRecord, 2, uid)
+        return self._userAt(i) if i is not None else None
+
+    def getGroup(self, groupname):
+        """returns PgsGrpRecord, None if not found"""
+        i = self._findByName(self._groupOff, self._groupRecord, self._groupCount, groupname)
+        return self._groupAt(i) if i is not None else None
+
+    def getGroupByGid(self, gid):
+        """returns PgsGrpRecord, None if not found"""
+        i = self._findById(self._groupIndexOff, self._groupCount, self._groupOff, self._groupRecord, 2, gid)
+        return self._groupAt(i) if i is not None else None
+
+    def getUserList(self, category=None):
+        """returns user name list, in name order"""
+        ret = []
+        for i in range(0, self._userCount):
+            t = self._userRecord.unpack_from(self._mm, self._userOff + i * self._userRecord.size)
+            if category is None or self._userCategoryList[t[10]] == category:
+                ret.append(self._str(t[0], t[1]))
+        return ret
+
+    def getGroupList(self, category=None):
+        """returns group name list, in name order"""
+        ret = []
+        for i in range(0, self._groupCount):
+            t = self._groupRecord.unpack_from(self._mm, self._groupOff + i * self._groupRecord.size)
+            if category is None or self._groupCategoryList[t[5]] == category:
+                ret.append(self._str(t[0], t[1]))
+        return ret
+
+    def getSecondaryGroupsOfUser(self, username):
+        """returns group name list"""
+        key = username.encode("utf-8")
+        size = self._memberRecord.size
+        i = self._lowerBound(self._memberCount, lambda i: self._bytes(*self._memberRecord.unpack_from(self._mm, self._memberOff + i * size)[:2]), key)
+        ret = []
+        while i < self._memberCount:
+            t = self._memberRecord.unpack_from(self._mm, self._memberOff + i * size)
+            if self._bytes(t[0], t[1]) != key:
+                break
+            g = self._groupRecord.unpack_from(self._mm, self._groupOff + t[2] * self._groupRecord.size)
+            ret.append(self._str(g[0], g[1]))
+            i += 1
+        return sorted(ret)
+
+    def _attach(self):
+        self._f = open(self.filename, "rb")
+        try:
+            st = os.fstat(self._f.fileno())
+            self._fileId = (st.st_dev, st.st_ino)
+            self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, self._generation, self._userCount, self._groupCount, self._memberCount = self._header.unpack_from(self._mm, 0)
+            if magic != self._magic or version != self._formatVersion:
+                raise PgsFormatError("Invalid format of shared model file %s" % (self.filename))
+        except:
+            self._detach()
+            raise
+
+        self._userOff = self._header.size
+        self._userIndexOff = self._userOff + self._userCount * self._userRecord.size
+        self._groupOff = self._userIndexOff + self._userCount * self._index.size
+        self._groupIndexOff = self._groupOff + self._groupCount * self._groupRecord.size
+        self._memberOff = self._groupIndexOff + self._groupCount * self._index.size
+        self._strOff = self._memberOff + self._memberCount * self._memberRecord.size
+
+    def _detach(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def _bytes(self, off, length):
+        return self._mm[self._strOff + off:self._strOff + off + length]
+
+    def _str(self, off, length):
+        return self._bytes(off, length).decode("utf-8")
+
+    def _userAt(self, i):
+        t = self._userRecord.unpack_from(self._mm, self._userOff + i * self._userRecord.size)
+        return PgsPwdRecord(self._userCategoryList[t[10]], self._str(t[0], t[1]), "x", t[2], t[3], self._str(t[4], t[5]), self._str(t[6], t[7]), self._str(t[8], t[9]))
+
+    def _groupAt(self, i):
+        t = self._groupRecord.unpack_from(self._mm, self._groupOff + i * self._groupRecord.size)
+        return PgsGrpRecord(self._groupCategoryList[t[5]], self._str(t[0], t[1]), "x", t[2], self._str(t[3], t[4]))
+
+    def _findByName(self, tableOff, record, count, name):
+        key = name.encode("utf-8")
+        i = self._lowerBound(count, lambda i: self._bytes(*record.unpack_from(self._mm, tableOff + i * record.size)[:2]), key)
+        if i < count and self._bytes(*record.unpack_from(self._mm, tableOff + i * record.size)[:2]) == key:
+            return i
+        return None
+
+    def _findById(self, indexOff, count, tableOff, record, idField, theId):
+        def getRecordIndex(i):
+            return self._index.unpack_from(self._mm, indexOff + i * self._index.size)[0]
+
+        def getId(i):
+            return record.unpack_from(self._mm, tableOff + getRecordIndex(i) * record.size)[idField]
+
+        i = self._lowerBound(count, getId, theId)
+        if i < count and getId(i) == theId:
+            return getRecordIndex(i)
+        return None
+
+    @staticmethod
+    def _lowerBound(count, keyFunc, key):
+        lo = 0
+        hi = count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if keyFunc(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    @classmethod
+    def _publish(cls, filename, userList, groupList):
+        strBuf = bytearray()
+        strDict = dict()
+
+        def addStr(theStr):
+            if theStr not in strDict:
+                b = theStr.encode("utf-8")
+                strDict[theStr] = (len(strBuf), len(b))
+                strBuf.extend(b)
+            return strDict[theStr]
+
+        userList = sorted(userList, key=lambda x: x.pw_name.encode("utf-8"))
+        groupList = sorted(groupList, key=lambda x: x.gr_name.encode("utf-8"))
+        memberList = []
+        for i, g in enumerate(groupList):
+            for u in g.gr_mem.split(","):
+                if u != "":
+                    memberList.append((u.encode("utf-8"), u, i))
+        memberList.sort()
+
+        # generation number increases from the one currently published
+        generation = 1
+        try:
+            with open(filename, "rb") as f:
+                magic, version, oldGeneration = cls._header.unpack(f.read(cls._header.size))[:3]
+                if magic == cls._magic:
+                    generation = oldGeneration + 1
+        except (OSError, struct.error):
+            pass
+
+        buf = bytearray()
+        buf += cls._header.pack(cls._magic, cls._formatVersion, generation, len(userList), len(groupList), len(memberList))
+        for u in userList:
+            buf += cls._userRecord.pack(*addStr(u.pw_name), u.pw_uid, u.pw_gid, *addStr(u.pw_gecos), *addStr(u.pw_dir), *addStr(u.pw_shell),
+                                        cls._userCategoryList.index(u.category))
+        for i in sorted(range(0, len(userList)), key=lambda x: userList[x].pw_uid):
+            buf += cls._index.pack(i)
+        for g in groupList:
+            buf += cls._groupRecord.pack(*addStr(g.gr_name), g.gr_gid, *addStr(g.gr_mem), cls._groupCategoryList.index(g.category))
+        for i in sorted(range(0, len(groupList)), key=lambda x: groupList[x].gr_gid):
+            buf += cls._index.pack(i)
+        for k, u, i in memberList:
+            buf += cls._memberRecord.pack(*addStr(u), i)
+        buf += strBuf
+
+        # replace atomically, readers still attached to the old generation are not affected
+        fd, tmpFile = tempfile.mkstemp(prefix=os.path.basename(filename) + ".", dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            with open(fd, "wb") as f:
+                os.fchmod(fd, 0o644)
+                f.write(buf)
+                f.flush()
+                os.fsync(fd)
+            os.rename(tmpFile, filename)
+        except:
+            os.unlink(tmpFile)
+            raise
+
+
+def iterPasswd(dirPrefix="/"):
+    """yields PgsPwdRecord for each entry in /etc/passwd without building the whole model,
+       category is classified the same way as PasswdGroupShadow does"""
+
+    ld = PasswdGroupShadow._readLoginDef(os.path.join(dirPrefix, "etc", "login.defs"))
+    for t in _iterAccountFile(os.path.join(dirPrefix, "etc", "passwd"), 7, "passwd"):
+        uid = int(t[2])
+        category = PasswdGroupShadow._classifyUser(t[0], uid, ld["UID_MIN"], ld["UID_MAX"])
+        yield PgsPwdRecord(category, t[0], t[1], uid, int(t[3]), t[4], t[5], t[6])
+
+
+def iterGroup(dirPrefix="/", normalUserSet=None):
+    """yields PgsGrpRecord for each entry in /etc/group without building the whole model,
+       category is classified the same way as PasswdGroupShadow does
+       normalUserSet is collected from /etc/passwd if not specified, memory used is then O(number of normal users),
+       pass it in to keep memory constant"""
+
+    ld = PasswdGroupShadow._readLoginDef(os.path.join(dirPrefix, "etc", "login.defs"))
+    if normalUserSet is None:
+        normalUserSet = set(x.pw_name for x in iterPasswd(dirPrefix) if x.category == "normal")
+    for t in _iterAccountFile(os.path.join(dirPrefix, "etc", "group"), 4, "group"):
+        gid = int(t[2])
+        category = PasswdGroupShadow._classifyGroup(t[0], gid, normalUserSet, ld["GID_MIN"], ld["GID_MAX"])
+        yield PgsGrpRecord(category, t[0], t[1], gid, t[3])
+
+
+def iterShadow(dirPrefix="/"):
+    """yields PgsShadowRecord for each entry in /etc/shadow"""
+
+    for t in _iterAccountFile(os.path.join(dirPrefix, "etc", "shadow"), 9, "shadow"):
+        yield PgsShadowRecord(t[0], t[1])
+
+
+def iterSubUid(dirPrefix="/"):
+    """yields PgsSubUidGidRecord for each entry in /etc/subuid, yields nothing if the file doesn't exist"""
+
+    filename = os.path.join(dirPrefix, "etc", "subuid")
+    if not os.path.exists(filename):
+        return
+    for t in _iterAccountFile(filename, 3, "subuid"):
+        yield PgsSubUidGidRecord(t[0], int(t[1]), int(t[2]))
+
+
+def iterSubGid(dirPrefix="/"):
+    """yields PgsSubUidGidRecord for each entry in /etc/subgid, yields nothing if the file doesn't exist"""
+
+    filename = os.path.join(dirPrefix, "etc", "subgid")
+    if not os.path.exists(filename):
+        return
+    for t in _iterAccountFile(filename, 3, "subgid"):
+        yield PgsSubUidGidRecord(t[0], int(t[1]), int(t[2]))
+
+
+def _splitAccountFile(buf, fieldNum, fileDesc):
+    """returns the field list of each entry"""
+
+    ret = []
+    for line in buf.split("\n"):
+        if line == "" or line.startswith("#"):
+            continue
+
+        t = line.split(":")
+        if len(t) != fieldNum:
+            raise PgsFormatError("Invalid format of %s file" % (fileDesc))
+        ret.append(t)
+    return ret
+
+
+def _iterAccountFile(filename, fieldNum, fileDesc):
+    """reads the file line by line, yields the field list of each entry"""
+
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line == "" or line.startswith("#"):
+                continue
+
+            t = line.split(":")
+            if len(t) != fieldNum:
+                raise PgsFormatError("Invalid format of %s file" % (fileDesc))
+            yield t
+
+
+def replayTrace(traceFile, dirPrefix, dbFile=None):
+    """replay the API calls recorded in traceFile against account files in dirPrefix, which should be a synthetic or copied one
+       calls are replayed one by one in the order of their start time, redacted passwords are replaced by a fixed one
+       calibrateHashPolicy() is replayed by setting the recorded result, so that hashing costs the same as on the traced host
+       instances opened with PgsSqliteBackend use dbFile, which is "pgs-replay.db" in dirPrefix by default,
+       other backends are replayed by PgsFlatFileBackend
+       returns dict, key: function name; value: latency list (in seconds)"""
+
+    if dbFile is None:
+        dbFile = os.path.join(dirPrefix, "pgs-replay.db")
+
+    recordList = []
+    with open(traceFile, "r") as f:
+        for line in f:
+            if line.strip() != "":
+                recordList.append(json.loads(line))
+    recordList.sort(key=lambda x: x["t"])
+
+    ret = dict()
+    objDict = dict()                # key: instance key in trace; value: PasswdGroupShadow object
+    backendList = []
+    for r in recordList:
+        op = r["op"]
+        kargs = r["a"]
+        kwargs = r.get("k", dict())
+        obj = None
+        if op != "open":
+            obj = objDict.get(r["i"])
+            if obj is None or not obj.valid:
+                continue
+        if op == "renumber":
+            kargs = [dict(x) if x is not None else None for x in kargs]
+            kwargs = {k: dict(v) if v is not None else None for k, v in kwargs.items()}
+
+        t = time.perf_counter()
+        try:
+            if op == "open":
+                backend = None
+                if kwargs.get("backend") == "PgsSqliteBackend":
+                    backend = PgsSqliteBackend(dbFile)
+                    backendList.append(backend)
+                objDict[r["i"]] = PasswdGroupShadow(dirPrefix, readOnly=kargs[1], optimistic=kargs[2], threadSafe=kargs[3], backend=backend,
+                                                    auditOnly=kwargs.get("auditOnly", False))
+            elif op == "calibrateHashPolicy" and "h" in r:
+                obj.setHashPolicy(*r["h"])
+            else:
+                getattr(obj, op)(*kargs, **kwargs)
+        except Exception:
+            # failure of the original call is part of the workload
+            if "e" not in r:
+                raise
+        ret.setdefault(op, []).append(time.perf_counter() - t)
+
+    for obj in objDict.values():
+        if obj.valid:
+            obj.close()
+    for backend in backendList:
+        backend.close()
+    return ret
+
+
+def getTraceStats(latencyDict):
+    """returns per-operation latency statistics of the result of replayTrace()
+       dict, key: function name; value: dict of count, total, p50, p90, p99, max"""
+
+    ret = dict()
+    for op, latencyList in latencyDict.items():
+        latencyList = sorted(latencyList)
+        n = len(latencyList)
+        ret[op] = {
+            "count": n,
+            "total": sum(latencyList),
+            "p50": latencyList[max(0, (n * 50 + 99) // 100 - 1)],
+            "p90": latencyList[max(0, (n * 90 + 99) // 100 - 1)],
+            "p99": latencyList[max(0, (n * 99 + 99) // 100 - 1)],
+            "max": latencyList[-1],
+        }
+    return ret
+
+
+def compareTraceStats(baseStats, newStats):
+    """compare two results of getTraceStats()
+       returns dict, key: function name; value: dict of new / base ratio of p50, p90, p99, max"""
+
+    ret = dict()
+    for op in sorted(set(baseStats.keys()) & set(newStats.keys())):
+        ret[op] = dict()
+        for k in ["p50", "p90", "p99", "max"]:
+            if baseStats[op][k] > 0:
+                ret[op][k] = newStats[op][k] / baseStats[op][k]
+            else:
+                ret[op][k] = None
+    return ret
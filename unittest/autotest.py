@@ -0,0 +1,866 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import sys
+import stat
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python3"))
+import wgtk
+
+
+class _TreeTestCase(unittest.TestCase):
+
+    loginDefs = "\n".join([
+        "UID_MIN 1000",
+        "UID_MAX 60000",
+        "GID_MIN 1000",
+        "GID_MAX 60000",
+        "SUB_UID_MIN 100000",
+        "SUB_UID_MAX 589924000",
+        "SUB_UID_COUNT 65536",
+        "SUB_GID_MIN 100000",
+        "SUB_GID_MAX 589924000",
+        "SUB_GID_COUNT 65536",
+        "ENCRYPT_METHOD SHA512",
+        "SHA_CRYPT_MIN_ROUNDS 5000",
+        "SHA_CRYPT_MAX_ROUNDS 5000",
+    ]) + "\n"
+
+    def setUp(self):
+        self.dirPrefix = tempfile.mkdtemp()
+        etcDir = os.path.join(self.dirPrefix, "etc")
+        os.mkdir(etcDir)
+
+        passwd = ["root:x:0:0::/root:/bin/bash", "nobody:x:65534:65534::/:/sbin/nologin"]
+        group = ["root:x:0:", "nobody:x:65534:", "nogroup:x:65533:", "wheel:x:10:", "users:x:100:"]
+        shadow = ["root:$6$abcdefgh$xxxxxxxx:::::::", "nobody:!:::::::"]
+        subuid = []
+        for i in range(0, 3):
+            passwd.append("u%d:x:%d:%d::/home/u%d:/bin/bash" % (i, 1000 + i, 1000 + i, i))
+            group.append("u%d:x:%d:" % (i, 1000 + i))
+            shadow.append("u%d:$6$saltsalt$hashhashhash:::::::" % (i))
+            subuid.append("u%d:%d:65536" % (i, 100000 + i * 65536))
+
+        for fn, lineList in [("passwd", passwd), ("group", group), ("shadow", shadow), ("subuid", subuid), ("subgid", subuid)]:
+            with open(os.path.join(etcDir, fn), "w") as f:
+                f.write("\n".join(lineList) + "\n")
+        with open(os.path.join(etcDir, "gshadow"), "w") as f:
+            pass
+        with open(os.path.join(etcDir, "login.defs"), "w") as f:
+            f.write(self.loginDefs)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirPrefix)
+
+    def _changeByOthers(self):
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False) as pgs:
+            pgs.addStandAloneGroup("g_other")
+
+    def _load(self):
+        return wgtk.PasswdGroupShadow(self.dirPrefix)
+
+    def _setLoginDef(self, key, value):
+        fn = os.path.join(self.dirPrefix, "etc", "login.defs")
+        with open(fn) as f:
+            lineList = [x for x in f.read().split("\n") if x != "" and x.split()[0] != key]
+        if value is not None:
+            lineList.append("%s %s" % (key, value))
+        with open(fn, "w") as f:
+            f.write("\n".join(lineList) + "\n")
+
+    def _isLocked(self):
+        # lockf() locks are per-process, check it in another process
+        script = "import fcntl, os, sys; fd = os.open(sys.argv[1], os.O_WRONLY | os.O_CREAT); fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)"
+        ret = subprocess.run([sys.executable, "-c", script, os.path.join(self.dirPrefix, "etc", ".pwd.lock")], stderr=subprocess.DEVNULL)
+        return ret.returncode != 0
+
+    def _replaceInFile(self, filename, old, new):
+        fn = os.path.join(self.dirPrefix, "etc", filename)
+        with open(fn) as f:
+            buf = f.read()
+        self.assertIn(old, buf)
+        with open(fn, "w") as f:
+            f.write(buf.replace(old, new))
+
+    def _getShadow(self, username):
+        for r in wgtk.iterShadow(self.dirPrefix):
+            if r.sh_name == username:
+                return r.sh_encpwd
+        return None
+
+
+class TestSnapshot(_TreeTestCase):
+
+    def test_discarded_snapshot_is_not_replayed(self):
+        pgs = wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False, optimistic=True)
+        pgs.addStandAloneGroup("g_parent")
+        snapshot = pgs.snapshot()
+        snapshot.addStandAloneGroup("g_whatif")
+        snapshot.removeNormalUser("u1")
+        snapshot.close()
+        self._changeByOthers()
+        pgs.close()
+
+        with self._load() as pgs:
+            self.assertIn("u1", pgs.getNormalUserList())
+            self.assertEqual(pgs.getStandAloneGroupList(), ["g_other", "g_parent"])
+
+    def test_promote_takes_over_journal(self):
+        pgs = wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False, optimistic=True)
+        pgs.addStandAloneGroup("g_before")
+        snapshot = pgs.snapshot()
+        pgs.addStandAloneGroup("g_discarded")
+        snapshot.addStandAloneGroup("g_promoted")
+        pgs.promote(snapshot)
+        self._changeByOthers()
+        pgs.close()
+
+        with self._load() as pgs:
+            self.assertEqual(pgs.getStandAloneGroupList(), ["g_other", "g_before", "g_promoted"])
+
+
+class TestHashPolicy(_TreeTestCase):
+
+    def test_default_policy_from_login_defs(self):
+        with self._load() as pgs:
+            self.assertEqual((pgs.hashScheme, pgs.hashRounds), ("sha512_crypt", 5000))
+
+    def test_explicit_policy(self):
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False) as pgs:
+            pgs.setHashPolicy("sha256_crypt", 20000)
+            pgs.addNormalUser("carol", "password")
+        self.assertTrue(self._getShadow("carol").startswith("$5$rounds=20000$"))
+
+    def test_invalid_policy(self):
+        with self._load() as pgs:
+            self.assertRaises(ValueError, pgs.setHashPolicy, "no_such_crypt")
+            self.assertRaises(ValueError, pgs.setHashPolicy, "md5_crypt", 1000)
+
+    def test_min_rounds_greater_than_max_rounds(self):
+        self._setLoginDef("SHA_CRYPT_MIN_ROUNDS", 9000)
+        self.assertRaises(wgtk.PgsFormatError, wgtk.PasswdGroupShadow, self.dirPrefix, readOnly=False)
+
+        # lock is not held
+        self._setLoginDef("SHA_CRYPT_MIN_ROUNDS", 5000)
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False):
+            pass
+
+    def test_calibrate_is_clamped(self):
+        self._setLoginDef("SHA_CRYPT_MIN_ROUNDS", 6000)
+        self._setLoginDef("SHA_CRYPT_MAX_ROUNDS", 7000)
+        with self._load() as pgs:
+            self.assertEqual(pgs.calibrateHashPolicy(10.0), 7000)
+            self.assertEqual(pgs.hashRounds, 7000)
+            self.assertEqual(pgs.calibrateHashPolicy(0.000001), 6000)
+            self.assertEqual(pgs.hashRounds, 6000)
+
+    def test_calibrate_without_bounds(self):
+        self._setLoginDef("SHA_CRYPT_MIN_ROUNDS", None)
+        self._setLoginDef("SHA_CRYPT_MAX_ROUNDS", None)
+        with self._load() as pgs:
+            self.assertEqual(pgs.calibrateHashPolicy(0.000001), 1000)
+            self.assertEqual(pgs.hashScheme, "sha512_crypt")
+
+
+class TestVerifyPassword(_TreeTestCase):
+
+    def test_match(self):
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False) as pgs:
+            pgs.addNormalUser("carol", "password")
+            self.assertEqual(pgs.verifyPassword("carol", "password"), (True, False))
+            self.assertEqual(pgs.verifyPassword("carol", "wrong"), (False, False))
+            self.assertEqual(pgs.verifyPassword("nosuchuser", "password"), (False, False))
+            self.assertEqual(pgs.verifyPassword("u0", "password"), (False, False))     # malformed hash
+            self.assertEqual(pgs.getStats()["verifyCount"], 4)
+
+    def test_needs_update(self):
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False) as pgs:
+            pgs.setHashPolicy("sha512_crypt", 20000)
+            pgs.addNormalUser("carol", "password")
+
+            # back to login.defs policy, in which 20000 rounds exceeds SHA_CRYPT_MAX_ROUNDS
+            pgs.setHashPolicy()
+            self.assertEqual(pgs.verifyPassword("carol", "password"), (True, True))
+            pgs.modifyNormalUser("carol", wgtk.MUSER_SET_PASSWORD, "password")
+            self.assertEqual(pgs.verifyPassword("carol", "password"), (True, False))
+
+            # deprecated scheme
+            pgs.setHashPolicy("md5_crypt")
+            pgs.modifyNormalUser("carol", wgtk.MUSER_SET_PASSWORD, "password")
+            pgs.setHashPolicy()
+            self.assertEqual(pgs.verifyPassword("carol", "password"), (True, True))
+
+
+class TestWrite(_TreeTestCase):
+
+    def _read(self, filename):
+        with open(os.path.join(self.dirPrefix, "etc", filename)) as f:
+            return f.read()
+
+    def test_content(self):
+        oldPasswd = self._read("passwd")
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False) as pgs:
+            pgs.addStandAloneGroup("g0")
+            pgs.modifyNormalUser("u1", wgtk.MUSER_JOIN_GROUP, "g0")
+
+        self.assertEqual(self._read("passwd"), "\n".join([
+            "# manged by strict_pgs",
+            "",
+            "root:x:0:0::/root:/bin/bash",
+            "nobody:x:65534:65534::/:/sbin/nologin",
+            "",
+            "u0:x:1000:1000::/home/u0:/bin/bash",
+            "u1:x:1001:1001::/home/u1:/bin/bash",
+            "u2:x:1002:1002::/home/u2:/bin/bash",
+            "",
+            "",
+            "",
+        ]))
+        self.assertEqual(self._read("group"), "\n".join([
+            "# manged by strict_pgs",
+            "",
+            "root:x:0:",
+            "nobody:x:65534:",
+            "nogroup:x:65533:",
+            "wheel:x:10:",
+            "users:x:100:",
+            "",
+            "u0:x:1000:",
+            "u1:x:1001:",
+            "u2:x:1002:",
+            "",
+            "g0:x:5000:u1",
+            "",
+            "",
+            "",
+            "",
+        ]))
+        self.assertEqual(self._read("subuid"), "\n".join([
+            "# manged by strict_pgs",
+            "",
+            "u0:100000:65536",
+            "u1:165536:65536",
+            "u2:231072:65536",
+            "",
+        ]))
+        self.assertEqual(self._read("gshadow"), "")
+        self.assertEqual(self._read("passwd-"), oldPasswd)
+        self.assertEqual([x for x in os.listdir(os.path.join(self.dirPrefix, "etc")) if x.endswith("+")], [])
+
+        # output is stable
+        contentList = [self._read(x) for x in ["passwd", "group", "shadow", "gshadow", "subuid", "subgid"]]
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False):
+            pass
+        self.assertEqual([self._read(x) for x in ["passwd", "group", "shadow", "gshadow", "subuid", "subgid"]], contentList)
+
+    def test_mode_and_owner(self):
+        fn = os.path.join(self.dirPrefix, "etc", "shadow")
+        os.chmod(fn, 0o640)
+        if os.getuid() == 0:
+            os.chown(fn, 0, 42)
+        st = os.stat(fn)
+
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False) as pgs:
+            pgs.addNormalUser("carol", "password")
+
+        st2 = os.stat(fn)
+        self.assertNotEqual(st.st_ino, st2.st_ino)
+        self.assertEqual((stat.S_IMODE(st2.st_mode), st2.st_uid, st2.st_gid), (0o640, st.st_uid, st.st_gid))
+        self.assertIn("carol:", self._read("shadow"))
+
+
+class TestCommit(_TreeTestCase):
+
+    def test_commit_keeps_object_valid(self):
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False) as pgs:
+            pgs.addStandAloneGroup("g0")
+            pgs.commit()
+            self.assertTrue(self._isLocked())
+            with self._load() as other:
+                self.assertEqual(other.getStandAloneGroupList(), ["g0"])
+            pgs.addStandAloneGroup("g1")
+        with self._load() as pgs:
+            self.assertEqual(pgs.getStandAloneGroupList(), ["g0", "g1"])
+
+    def test_switch_to_optimistic(self):
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False) as pgs:
+            pgs.addStandAloneGroup("g0")
+            pgs.commit(keepLock=False)
+            self.assertTrue(pgs.optimistic)
+            self.assertFalse(self._isLocked())
+            pgs.addStandAloneGroup("g1")
+            self._changeByOthers()
+            pgs.commit()
+            self.assertFalse(self._isLocked())
+        with self._load() as pgs:
+            self.assertEqual(pgs.getStandAloneGroupList(), ["g0", "g_other", "g1"])
+
+    def test_switch_to_pessimistic(self):
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False, optimistic=True) as pgs:
+            pgs.addStandAloneGroup("g0")
+            self._changeByOthers()
+            self.assertFalse(self._isLocked())
+            pgs.commit(keepLock=True)
+            self.assertFalse(pgs.optimistic)
+            self.assertTrue(self._isLocked())
+            pgs.addStandAloneGroup("g1")
+        self.assertFalse(self._isLocked())
+        with self._load() as pgs:
+            self.assertEqual(pgs.getStandAloneGroupList(), ["g_other", "g0", "g1"])
+
+    def test_group_commit(self):
+        pgs = wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False, threadSafe=True)
+        errorList = []
+
+        def _run(i):
+            try:
+                pgs.addStandAloneGroup("g%d" % (i))
+                pgs.commit(groupCommitWindow=0.5)
+            except Exception as e:
+                errorList.append(e)
+        threadList = [threading.Thread(target=_run, args=(i,)) for i in range(0, 5)]
+        for t in threadList:
+            t.start()
+        for t in threadList:
+            t.join()
+
+        self.assertEqual(errorList, [])
+        self.assertEqual(pgs._groupCommitBatch, 2)          # all the calls are merged into one write
+        with self._load() as other:
+            self.assertEqual(len(other.getStandAloneGroupList()), 5)
+        pgs.close()
+
+    def test_group_commit_error(self):
+        pgs = wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False, threadSafe=True)
+        pgs.backend = None
+        errorList = []
+
+        def _run():
+            try:
+                pgs.commit(groupCommitWindow=0.5)
+            except Exception as e:
+                errorList.append(e)
+        threadList = [threading.Thread(target=_run) for i in range(0, 3)]
+        for t in threadList:
+            t.start()
+        for t in threadList:
+            t.join()
+
+        self.assertEqual(len(errorList), 3)
+        self.assertEqual((pgs._groupCommitErrorDict, pgs._groupCommitFollowerDict), ({}, {}))
+        pgs.backend = wgtk.PgsFlatFileBackend()
+        pgs.close()
+
+
+class TestTrace(_TreeTestCase):
+
+    def test_redact_and_replay(self):
+        replayDir = os.path.join(tempfile.mkdtemp(), "replay")
+        self.addCleanup(shutil.rmtree, os.path.dirname(replayDir))
+        shutil.copytree(self.dirPrefix, replayDir)
+        traceFile = os.path.join(self.dirPrefix, "trace")
+
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False, traceFile=traceFile) as pgs:
+            pgs.setHashPolicy("sha256_crypt", 6000)
+            pgs.addNormalUser("carol", "s3cret")
+            pgs.modifyNormalUser("carol", wgtk.MUSER_SET_PASSWORD, "s3cret2")
+            pgs.modifyNormalUser("carol", wgtk.MUSER_JOIN_GROUP, "wheel")
+            pgs.verifyPassword("carol", "s3cret2")
+            pgs.renumber(uidMap={1000: 2000})
+            self.assertRaises(AssertionError, pgs.addStandAloneGroup, "u1")
+            pgs.addStandAloneGroup("g0")
+
+        with open(traceFile) as f:
+            buf = f.read()
+        self.assertNotIn("s3cret", buf)
+        recordList = [json.loads(x) for x in buf.split("\n") if x != ""]
+        self.assertEqual([x["op"] for x in recordList], ["open", "setHashPolicy", "addNormalUser", "modifyNormalUser", "modifyNormalUser",
+                                                         "verifyPassword", "renumber", "addStandAloneGroup", "addStandAloneGroup", "close"])
+        self.assertEqual(recordList[0]["k"]["backend"], "PgsFlatFileBackend")
+        self.assertEqual(recordList[1]["h"], ["sha256_crypt", 6000])
+        self.assertEqual(recordList[7]["e"], "AssertionError")
+
+        latencyDict = wgtk.replayTrace(traceFile, replayDir)
+        self.assertEqual(len(latencyDict["addStandAloneGroup"]), 2)
+        for fn in ["passwd", "group", "subuid", "subgid"]:
+            with open(os.path.join(self.dirPrefix, "etc", fn)) as f1, open(os.path.join(replayDir, "etc", fn)) as f2:
+                self.assertEqual(f1.read(), f2.read())
+        with wgtk.PasswdGroupShadow(replayDir) as pgs:
+            self.assertTrue(pgs.shDict["carol"].sh_encpwd.startswith("$5$rounds=6000$"))
+
+        stats = wgtk.getTraceStats(latencyDict)
+        self.assertEqual(stats["addStandAloneGroup"]["count"], 2)
+        self.assertEqual(set(wgtk.compareTraceStats(stats, stats)["close"].values()), set([1.0]))
+
+
+class TestSqliteBackend(_TreeTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.backend = wgtk.PgsSqliteBackend(os.path.join(self.dirPrefix, "account.db"))
+        with self._open():
+            pass
+
+    def tearDown(self):
+        self.backend.close()
+        super().tearDown()
+
+    def _open(self, readOnly=False, optimistic=False):
+        return wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=readOnly, optimistic=optimistic, backend=self.backend)
+
+    def _startCount(self):
+        sqlList = []
+        self.backend._conn.set_trace_callback(sqlList.append)
+        return sqlList
+
+    def _rowWriteCount(self, sqlList):
+        tableList = ["passwd", "grp", "shadow", "subuid", "subgid"]
+        return len([x for x in sqlList if any(x.startswith(y) for y in ["INSERT OR REPLACE INTO %s " % (t) for t in tableList] + ["DELETE FROM %s " % (t) for t in tableList])])
+
+    def _checkOrder(self):
+        # order of the rows in database reproduces the flat files
+        with wgtk.PasswdGroupShadow(self.dirPrefix) as pgs:
+            expected = pgs._genAll()
+        with self._open(readOnly=True) as pgs:
+            self.assertEqual(pgs._genAll(), expected)
+
+    def _pos(self, table):
+        return [x[0] for x in self.backend._conn.execute("SELECT pos FROM %s ORDER BY pos" % (table))]
+
+    def test_load_from_database(self):
+        with self.backend._conn:
+            self.backend._conn.execute("UPDATE passwd SET shell = '/bin/zsh' WHERE name = 'u0'")
+        with self._open() as pgs:
+            self.assertEqual(pgs.pwdDict["u0"].pw_shell, "/bin/zsh")
+        with wgtk.PasswdGroupShadow(self.dirPrefix) as pgs:
+            self.assertEqual(pgs.pwdDict["u0"].pw_shell, "/bin/zsh")
+
+    def test_lookup(self):
+        with self._open() as pgs:
+            pgs.addStandAloneGroup("g0")
+            pgs.modifyNormalUser("u1", wgtk.MUSER_JOIN_GROUP, "g0")
+        self.assertEqual(self.backend.getUser("u1"), wgtk.PgsPwdRecord("normal", "u1", "x", 1001, 1001, "", "/home/u1", "/bin/bash"))
+        self.assertEqual(self.backend.getUserByUid(65534).pw_name, "nobody")
+        self.assertEqual(self.backend.getGroup("g0"), wgtk.PgsGrpRecord("stand-alone", "g0", "x", 5000, "u1"))
+        self.assertEqual(self.backend.getGroupByGid(1002).gr_name, "u2")
+        self.assertIsNone(self.backend.getUser("nosuchuser"))
+        self.assertIsNone(self.backend.getUserByUid(1003))
+        self.assertIsNone(self.backend.getGroup("nosuchgroup"))
+        self.assertIsNone(self.backend.getGroupByGid(5001))
+
+    def test_member_index(self):
+        with self._open() as pgs:
+            pgs.addStandAloneGroup("g0")
+            pgs.addStandAloneGroup("g1")
+            pgs.modifyNormalUser("u1", wgtk.MUSER_JOIN_GROUP, "g0")
+            pgs.modifyNormalUser("u1", wgtk.MUSER_JOIN_GROUP, "g1")
+            pgs.modifyNormalUser("u2", wgtk.MUSER_JOIN_GROUP, "g1")
+        self.assertEqual(self.backend.getSecondaryGroupsOfUser("u1"), ["g0", "g1"])
+        self.assertEqual(self.backend.getSecondaryGroupsOfUser("u2"), ["g1"])
+
+        with self._open() as pgs:
+            pgs.modifyNormalUser("u1", wgtk.MUSER_LEAVE_GROUP, "g0")
+            pgs.removeStandAloneGroup("g1")
+        self.assertEqual(self.backend.getSecondaryGroupsOfUser("u1"), [])
+        self.assertEqual(self.backend.getSecondaryGroupsOfUser("u2"), [])
+
+        with self._open() as pgs:
+            pgs.modifyNormalUser("u2", wgtk.MUSER_JOIN_GROUP, "g0")
+            pgs.removeNormalUser("u2")
+        self.assertEqual(self.backend.getSecondaryGroupsOfUser("u2"), [])
+        self.assertEqual(self.backend.getGroup("g0").gr_mem, "")
+
+    def test_incremental_store(self):
+        sqlList = self._startCount()
+        with self._open() as pgs:
+            pgs.removeNormalUser("u1")
+        self.assertEqual(self._rowWriteCount(sqlList), 5)
+        self._checkOrder()
+
+        sqlList = self._startCount()
+        with self._open() as pgs:
+            pgs.addNormalUser("carol", "password")
+        self.assertEqual(self._rowWriteCount(sqlList), 5)
+        self._checkOrder()
+
+        sqlList = self._startCount()
+        with self._open() as pgs:
+            pgs.renumber(uidMap={1002: 3000})
+        self.assertEqual(self._rowWriteCount(sqlList), 2)
+        self._checkOrder()
+
+    def test_renumber_all_rows(self):
+        self.backend.close()
+        self.backend = wgtk.PgsSqliteBackend(os.path.join(self.dirPrefix, "account2.db"))
+        self.backend._posStep = 4
+        with self._open() as pgs:
+            pgs.addStandAloneGroup("g0")
+            n = len(pgs.systemGroupList)
+        self.assertEqual(self._pos("grp"), [x * 4 for x in range(1, n + 5)])
+
+        # per-user groups are put between u2 and g0, until there's no room
+        lo = (n + 3) * 4
+        for i, posList in enumerate([[lo, lo + 2, lo + 4], [lo, lo + 2, lo + 3, lo + 4]]):
+            with self._open() as pgs:
+                pgs.addNormalUser("n%d" % (i), "password")
+            self.assertEqual(self._pos("grp")[n + 2:], posList)
+            self._checkOrder()
+
+        with self._open() as pgs:
+            pgs.addNormalUser("n2", "password")
+        self.assertEqual(self._pos("grp"), [x * 4 for x in range(1, n + 8)])
+        self._checkOrder()
+
+    def test_change_by_others_is_imported(self):
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False) as pgs:
+            pgs.addStandAloneGroup("g_other")
+        with self._open() as pgs:
+            self.assertEqual(pgs.getStandAloneGroupList(), ["g_other"])
+            pgs.addStandAloneGroup("g_mine")
+        self.assertEqual(self.backend.getGroup("g_other").gr_gid, 5000)
+        with wgtk.PasswdGroupShadow(self.dirPrefix) as pgs:
+            self.assertEqual(pgs.getStandAloneGroupList(), ["g_other", "g_mine"])
+
+    def test_change_by_others_in_optimistic_mode(self):
+        pgs = self._open(optimistic=True)
+        pgs.addNormalUser("mine", "password")
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False) as other:
+            other.addNormalUser("theirs", "password")
+        pgs.close()
+
+        with wgtk.PasswdGroupShadow(self.dirPrefix) as pgs:
+            self.assertEqual(pgs.getNormalUserList(), ["u0", "u1", "u2", "theirs", "mine"])
+        self.assertEqual(self.backend.getUser("theirs").pw_uid, 1003)
+        self.assertEqual(self.backend.getUser("mine").pw_uid, 1004)
+
+    def test_change_by_others_during_session(self):
+        pgs = self._open()
+        pgs.addStandAloneGroup("g_mine")
+        self._replaceInFile("group", "users:x:100:", "users:x:100:u0")
+        with self.assertRaises(wgtk.PgsConflictError):
+            pgs.close()
+        self.assertIn("users:x:100:u0", open(os.path.join(self.dirPrefix, "etc", "group")).read())
+        pgs._unlockPwd()
+
+
+class TestSubId(_TreeTestCase):
+
+    def test_owner(self):
+        with open(os.path.join(self.dirPrefix, "etc", "subuid"), "w") as f:
+            f.write("u0:100000:262144\n")         # covers 4 ranges
+            f.write("u1:165536:65536\n")          # inside the range of u0
+            f.write("u2:427680:65536\n")
+        with self._load() as pgs:
+            self.assertIsNone(pgs.ownerOfSubUid(99999))
+            self.assertEqual(pgs.ownerOfSubUid(100000), "u0")
+            self.assertIn(pgs.ownerOfSubUid(165536), ["u0", "u1"])
+            self.assertEqual(pgs.ownerOfSubUid(231072), "u0")        # after the end of u1
+            self.assertEqual(pgs.ownerOfSubUid(362143), "u0")
+            self.assertIsNone(pgs.ownerOfSubUid(362144))
+            self.assertEqual(pgs.ownerOfSubUid(427680), "u2")
+            self.assertIsNone(pgs.ownerOfSubUid(493216))
+            self.assertEqual(pgs.ownerOfSubGid(100000 + 65536 * 2), "u2")
+
+    def test_overlap(self):
+        with self._load() as pgs:
+            pgs.verify()
+        self._replaceInFile("subgid", "u2:231072:", "u2:165536:")
+        with self._load() as pgs:
+            with self.assertRaisesRegex(wgtk.PgsFormatError, "Subordinate Group ID range overlaps: u1 and u2"):
+                pgs.verify()
+
+
+@unittest.skipIf(wgtk.numpy is None, "numpy is not installed")
+class TestAudit(_TreeTestCase):
+
+    def _audit(self):
+        with wgtk.PasswdGroupShadow(self.dirPrefix, auditOnly=True) as pgs:
+            return pgs.audit()
+
+    def test_clean(self):
+        self.assertEqual(self._audit(), [])
+
+    def test_stage1_violations(self):
+        self._replaceInFile("shadow", "u1:$6$saltsalt$hashhashhash:::::::\n", "")
+        self._replaceInFile("shadow", "u2:$6$saltsalt$hashhashhash:", "u2:!:")
+        self._replaceInFile("group", "wheel:x:10:\n", "")
+        self._replaceInFile("subuid", "u0:100000:", "u0:100001:")
+        with self.assertRaises(wgtk.PgsFormatError):
+            self._load()
+        self.assertEqual(self._audit(), [
+            "No shadow entry for normal user u1",
+            "No password for normal user u2",
+            "Invalid system group list",
+            "Subordinate User ID is not aligned for user u0",
+            "Subordinate User ID range overlaps for user u1",
+        ])
+
+    def test_id_violations(self):
+        self._replaceInFile("passwd", "u1:x:1001:1001:", "u1:x:1003:1001:")
+        self._replaceInFile("passwd", "u2:x:1002:", "u2:x:1000:")
+        self.assertEqual(self._audit(), [
+            "Invalid normal user order at user u2",
+            "User ID and group ID not equal for normal user u1",
+            "User ID and group ID not equal for normal user u2",
+            "User ID 1000 is used by multiple users: u0, u2",
+        ])
+
+
+class TestRenumber(_TreeTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self._replaceInFile("passwd", "u2:x:1002:1002:", "u2:x:1002:5000:")
+        with open(os.path.join(self.dirPrefix, "etc", "group"), "a") as f:
+            f.write("g0:x:5000:u0\n")
+
+    def test_renumber(self):
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False) as pgs:
+            walker = pgs.renumber(uidMap={1001: 3001}, gidMap={5000: 5100})
+        self.assertEqual((walker.uidMap, walker.gidMap), ({1001: 3001}, {1001: 3001, 5000: 5100}))
+
+        with self._load() as pgs:
+            pgs.verify()
+            self.assertEqual(pgs.getNormalUserList(), ["u0", "u2", "u1"])
+            self.assertEqual((pgs.pwdDict["u1"].pw_uid, pgs.pwdDict["u1"].pw_gid, pgs.grpDict["u1"].gr_gid), (3001, 3001, 3001))
+            self.assertEqual(pgs.pwdDict["u2"].pw_gid, 5100)
+            self.assertEqual(pgs.grpDict["g0"].gr_gid, 5100)
+            self.assertEqual(pgs.getSecondaryGroupsOfUser("u0"), ["g0"])
+
+    def test_error(self):
+        for uidMap, gidMap, errMsg in [
+            ({0: 3000}, None, "User ID 0 does not belong to a normal user"),
+            ({1000: 999}, None, "User ID 999 out of range"),
+            (None, {1000: 5100}, "Group ID 1000 does not belong to a stand-alone group"),
+            (None, {5000: 60000}, "Group ID 60000 out of range"),
+            ({1000: 3000, 1001: 3000}, None, "Duplicate new ID"),
+            ({1000: 3000}, {5000: 3000}, "Duplicate new ID"),
+            ({1000: 1001}, None, "User ID 1001 is already in use"),
+            ({1000: 5000}, None, "Group ID 5000 is already in use"),
+            (None, {5000: 1002}, "Group ID 1002 is already in use"),
+        ]:
+            with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False) as pgs:
+                with self.assertRaisesRegex(wgtk.PgsRenumberError, errMsg):
+                    pgs.renumber(uidMap, gidMap)
+                self.assertEqual(pgs.pwdDict["u0"].pw_uid, 1000)
+                self.assertEqual(pgs.grpDict["g0"].gr_gid, 5000)
+
+    def test_group_renumbered_twice(self):
+        # normal user and stand-alone group with the same ID
+        self._replaceInFile("group", "g0:x:5000:", "g0:x:1001:")
+        with self._load() as pgs:
+            with self.assertRaisesRegex(wgtk.PgsRenumberError, "Group ID is renumbered twice"):
+                pgs.renumber({1001: 3001}, {1001: 3002})
+
+
+@unittest.skipUnless(os.getuid() == 0, "root privilege is needed for chown")
+class TestChownWalker(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.rootDir = os.path.join(self.tmpDir, "root")
+        self.pathList = []
+        for d in ["a", "a/b", "a/b/c", "d"]:
+            os.makedirs(os.path.join(self.rootDir, d))
+            self.pathList.append(os.path.join(self.rootDir, d))
+            fn = os.path.join(self.rootDir, d, "f")
+            with open(fn, "w"):
+                pass
+            self.pathList.append(fn)
+        self.pathList.append(self.rootDir)
+        for path in self.pathList:
+            os.lchown(path, 1001, 5000)
+
+        self.setuidFile = os.path.join(self.rootDir, "a", "f")
+        os.chmod(self.setuidFile, 0o6755)
+        self.symlink = os.path.join(self.rootDir, "d", "l")
+        os.symlink("/", self.symlink)
+        os.lchown(self.symlink, 1001, 1001)
+        self.otherFile = os.path.join(self.rootDir, "d", "o")
+        with open(self.otherFile, "w"):
+            pass
+        os.chown(self.otherFile, 1002, 1002)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _owner(self, path):
+        st = os.lstat(path)
+        return (st.st_uid, st.st_gid)
+
+    def test_run(self):
+        walker = wgtk.PgsChownWalker({1001: 3001}, {1001: 3001, 5000: 5100}, maxWorkers=3)
+        progressList = []
+        walker.run([self.rootDir], progressList.append)
+
+        for path in self.pathList:
+            self.assertEqual(self._owner(path), (3001, 5100), path)
+        self.assertEqual(self._owner(self.symlink), (3001, 3001))
+        self.assertEqual(self._owner("/"), (0, 0))
+        self.assertEqual(self._owner(self.otherFile), (1002, 1002))
+        self.assertEqual(stat.S_IMODE(os.stat(self.setuidFile).st_mode), 0o6755)
+        self.assertEqual(walker.getProgress(), {"dirCount": 5, "fileCount": 10, "changeCount": 9})
+        self.assertEqual(len(progressList), 5)
+
+    def test_resume(self):
+        stateFile = os.path.join(self.tmpDir, "state")
+        walker = wgtk.PgsChownWalker({1001: 3001}, {5000: 5100}, stateFile=stateFile)
+
+        # the first directory reporting progress fails
+        interruptList = [RuntimeError("interrupted")]
+
+        def interrupt(progress):
+            if len(interruptList) > 0:
+                raise interruptList.pop()
+        self.assertRaisesRegex(RuntimeError, "interrupted", walker.run, [self.rootDir], interrupt)
+        with open(stateFile) as f:
+            self.assertNotIn(self.rootDir + "\n", f.read())
+
+        # run again, only the unfinished directories are scanned
+        walker = wgtk.PgsChownWalker({1001: 3001}, {5000: 5100}, stateFile=stateFile)
+        walker.run([self.rootDir])
+        self.assertLess(walker.getProgress()["dirCount"], 5)
+        for path in self.pathList:
+            self.assertEqual(self._owner(path), (3001, 5100), path)
+
+        # all done
+        walker = wgtk.PgsChownWalker({1001: 3001}, {5000: 5100}, stateFile=stateFile)
+        walker.run([self.rootDir])
+        self.assertEqual(walker.getProgress()["dirCount"], 0)
+
+    def test_new_id_is_old_id(self):
+        self.assertRaises(ValueError, wgtk.PgsChownWalker, {1001: 1002, 1002: 1003}, {})
+
+
+class TestSharedModel(_TreeTestCase):
+
+    def test_lookup_and_refresh(self):
+        modelFile = os.path.join(self.dirPrefix, "model")
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False, sharedModelFile=modelFile) as pgs:
+            pgs.addStandAloneGroup("g0")
+            pgs.modifyNormalUser("u1", wgtk.MUSER_JOIN_GROUP, "g0")
+            pgs.modifyNormalUser("u1", wgtk.MUSER_JOIN_GROUP, "wheel")
+
+        with wgtk.PgsSharedModel(modelFile) as model:
+            self.assertEqual(model.getGeneration(), 1)
+            self.assertEqual(model.getUser("u1"), wgtk.PgsPwdRecord("normal", "u1", "x", 1001, 1001, "", "/home/u1", "/bin/bash"))
+            self.assertEqual(model.getUserByUid(0).pw_name, "root")
+            self.assertIsNone(model.getUser("nosuchuser"))
+            self.assertIsNone(model.getUserByUid(1003))
+            self.assertEqual(model.getGroup("g0"), wgtk.PgsGrpRecord("stand-alone", "g0", "x", 5000, "u1"))
+            self.assertEqual(model.getGroupByGid(1002).gr_name, "u2")
+            self.assertIsNone(model.getGroupByGid(5001))
+            self.assertEqual(model.getUserList("normal"), ["u0", "u1", "u2"])
+            self.assertEqual(model.getGroupList("per-user"), ["u0", "u1", "u2"])
+            self.assertEqual(model.getSecondaryGroupsOfUser("u1"), ["g0", "wheel"])
+            self.assertEqual(model.getSecondaryGroupsOfUser("u0"), [])
+
+            self.assertFalse(model.refresh())
+            with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False) as pgs:
+                pgs.addStandAloneGroup("g1")
+                pgs.publishSharedModel(modelFile)
+            self.assertIsNone(model.getGroup("g1"))
+            self.assertTrue(model.refresh())
+            self.assertEqual(model.getGeneration(), 2)
+            self.assertEqual(model.getGroup("g1").gr_gid, 5001)
+
+        self.assertEqual(sorted(os.listdir(self.dirPrefix)), ["etc", "model"])
+
+
+class TestHomeProvisioner(_TreeTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.provisioner = wgtk.PgsHomeProvisioner(maxWorkers=2)
+        for i in range(0, 3):
+            os.makedirs(os.path.join(self.dirPrefix, "home", "u%d" % (i)))
+
+    def tearDown(self):
+        self.provisioner.shutdown()
+        super().tearDown()
+
+    def _removeUser(self, username):
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False, homeProvisioner=self.provisioner) as pgs:
+            pgs.removeNormalUser(username)
+        self.assertEqual(self.provisioner.wait(10), [])
+        for future in self.provisioner.getFutureList():
+            future.result()
+
+    def test_provision_and_deprovision(self):
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False, homeProvisioner=self.provisioner) as pgs:
+            pgs.addNormalUser("carol", "password")
+        self.provisioner.wait(10)
+        st = os.stat(os.path.join(self.dirPrefix, "home", "carol"))
+        self.assertEqual((st.st_uid, stat.S_IMODE(st.st_mode)), (1003, 0o700))
+
+        self._removeUser("u1")
+        self.assertFalse(os.path.exists(os.path.join(self.dirPrefix, "home", "u1")))
+        self.assertEqual(len(os.listdir(os.path.join(self.dirPrefix, "var", "backups", "home"))), 1)
+
+    def test_shared_home_is_kept(self):
+        self._replaceInFile("passwd", "/home/u1:", "/home/u0:")
+        self._removeUser("u1")
+        self.assertTrue(os.path.isdir(os.path.join(self.dirPrefix, "home", "u0")))
+
+    def test_home_outside_home_base_is_kept(self):
+        self._replaceInFile("passwd", "/home/u1:", "/:")
+        self._removeUser("u1")
+        self.assertTrue(os.path.isdir(os.path.join(self.dirPrefix, "etc")))
+
+        self._replaceInFile("passwd", "/home/u2:", "/home:")
+        self._removeUser("u2")
+        self.assertTrue(os.path.isdir(os.path.join(self.dirPrefix, "home", "u0")))
+
+
+class TestOptimistic(_TreeTestCase):
+
+    def test_conflict_keeps_model(self):
+        pgs = wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False, optimistic=True)
+        pgs.addStandAloneGroup("gB")
+        pgs.modifyNormalUser("u0", wgtk.MUSER_JOIN_GROUP, "gB")
+        pgs.addNormalUser("carol", "password")
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False) as other:
+            other.addNormalUser("carol", "password")
+
+        with self.assertRaises(wgtk.PgsConflictError):
+            pgs.close()
+        self.assertEqual(pgs.getStandAloneGroupList(), ["gB"])
+        self.assertEqual(pgs.getSecondaryGroupsOfUser("u0"), ["gB"])
+
+        # the change is still detected, partial replay result is never written
+        with self.assertRaises(wgtk.PgsConflictError):
+            pgs.close()
+        with self._load() as pgs:
+            self.assertEqual(pgs.getStandAloneGroupList(), [])
+
+    @unittest.skipIf(sys.flags.optimize, "already optimized")
+    def test_conflict_without_assert(self):
+        # conflicts must be detected with assert statements removed
+        for testName in ["test_conflict_keeps_model", "test_conflict_on_group"]:
+            ret = subprocess.run([sys.executable, "-O", os.path.abspath(__file__), "TestOptimistic." + testName],
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+            self.assertEqual(ret.returncode, 0, ret.stdout)
+
+    def test_conflict_on_group(self):
+        pgs = wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False, optimistic=True)
+        pgs.addStandAloneGroup("g0")
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False) as other:
+            other.addStandAloneGroup("g0")
+        with self.assertRaises(wgtk.PgsConflictError):
+            pgs.close()
+
+        pgs = wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False, optimistic=True)
+        pgs.modifyNormalUser("u1", wgtk.MUSER_JOIN_GROUP, "g0")
+        with wgtk.PasswdGroupShadow(self.dirPrefix, readOnly=False) as other:
+            other.removeStandAloneGroup("g0")
+        with self.assertRaises(wgtk.PgsConflictError):
+            pgs.close()
+
+
+if __name__ == "__main__":
+    unittest.main()